@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+
+"""
+Verify that the files recorded in the database's 'files' table
+still exist on disk, and that their sizes and MD5 sums match
+those recorded. Files are hashed in parallel. The size and
+modification time of each file are stored in the 'file_audits'
+table so files that haven't changed since they were last found
+to be intact are not hashed again.
+
+Optionally, the output directory is searched for orphans
+(i.e. files that are not referred to by the database).
+"""
+
+import os
+import datetime
+import multiprocessing.pool
+
+import database
+import utils
+import config
+
+
+def get_files(db, after_id=0, limit=1000):
+    """Get a batch of non-deleted files, along with the state
+        recorded when they were last audited.
+
+        Inputs:
+            db: A Database object.
+            after_id: Only get files with IDs larger than this.
+                (Default: 0)
+            limit: The maximum number of files to get.
+                (Default: 1000)
+
+        Output:
+            rows: A list of file rows, ordered by file ID.
+    """
+    with db.transaction() as conn:
+        select = db.select([db.files.c.file_id,
+                            db.files.c.filepath,
+                            db.files.c.filename,
+                            db.files.c.md5sum,
+                            db.files.c.filesize,
+                            db.file_audits.c.filesize.label('audit_filesize'),
+                            db.file_audits.c.mtime.label('audit_mtime'),
+                            db.file_audits.c.status.label('audit_status')],
+                    from_obj=[db.files.\
+                        outerjoin(db.file_audits,
+                            onclause=db.file_audits.c.file_id ==
+                                    db.files.c.file_id)]).\
+                    where((db.files.c.is_deleted == False) &
+                          (db.files.c.file_id > after_id)).\
+                    order_by(db.files.c.file_id.asc()).\
+                    limit(limit)
+        results = conn.execute(select)
+        rows = results.fetchall()
+        results.close()
+    return rows
+
+
+def audit_file(row):
+    """Check a single file against its database row.
+
+        Input:
+            row: A row returned by 'get_files'.
+
+        Output:
+            state: A dictionary of values to record in the
+                'file_audits' table.
+    """
+    fn = os.path.join(row['filepath'], row['filename'])
+    state = {'file_id': row['file_id'],
+             'filesize': None,
+             'mtime': None,
+             'md5sum': None,
+             'note': None}
+    try:
+        st = os.stat(fn)
+    except OSError:
+        state['status'] = 'missing'
+        state['note'] = "File not found (%s)" % fn
+        return state
+    state['filesize'] = st.st_size
+    state['mtime'] = int(st.st_mtime)
+    if (row['audit_status'] == 'ok') and \
+            (row['audit_filesize'] == st.st_size) and \
+            (row['audit_mtime'] == int(st.st_mtime)):
+        # Unchanged since it was last found to be intact
+        state['status'] = 'ok'
+        state['md5sum'] = row['md5sum']
+        state['unchanged'] = True
+        return state
+    if st.st_size != row['filesize']:
+        state['status'] = 'mismatch'
+        state['note'] = "File size (%d) doesn't match DB (%d)" % \
+                        (st.st_size, row['filesize'])
+        return state
+    try:
+        state['md5sum'] = utils.get_md5sum(fn)
+    except IOError as exc:
+        state['status'] = 'missing'
+        state['note'] = "File could not be read (%s)" % str(exc)
+        return state
+    if state['md5sum'] != row['md5sum']:
+        state['status'] = 'mismatch'
+        state['note'] = "MD5 sum (%s) doesn't match DB (%s)" % \
+                        (state['md5sum'], row['md5sum'])
+    else:
+        state['status'] = 'ok'
+    return state
+
+
+def record_states(db, states):
+    """Record the results of auditing files.
+
+        Inputs:
+            db: A Database object.
+            states: A list of dictionaries returned by 'audit_file'.
+
+        Outputs:
+            None
+    """
+    # Files that were skipped don't need to be updated
+    states = [state for state in states if not state.get('unchanged')]
+    if not states:
+        return
+    now = datetime.datetime.now()
+    values = []
+    for state in states:
+        values.append({'file_id': state['file_id'],
+                       'filesize': state['filesize'],
+                       'mtime': state['mtime'],
+                       'md5sum': state['md5sum'],
+                       'status': state['status'],
+                       'note': state['note'],
+                       'last_audited': now})
+    with db.transaction() as conn:
+        delete = db.file_audits.delete().\
+                    where(db.file_audits.c.file_id.in_(
+                            [state['file_id'] for state in states]))
+        conn.execute(delete)
+        conn.execute(db.file_audits.insert(), values)
+
+
+def get_known_paths(db):
+    """Get the paths of all files the database refers to,
+        including the lock files of calibrator databases
+        (see 'calibrate.CaldbLock').
+
+        Input:
+            db: A Database object.
+
+        Output:
+            known: A set of file paths.
+    """
+    known = set()
+    with db.transaction() as conn:
+        for table, pathcol, namecol in \
+                    ((db.files, 'filepath', 'filename'),
+                     (db.diagnostics, 'diagnosticpath', 'diagnosticname'),
+                     (db.logs, 'logpath', 'logname'),
+                     (db.caldbs, 'caldbpath', 'caldbname')):
+            select = db.select([table.c[pathcol], table.c[namecol]])
+            results = conn.execute(select)
+            for path, name in results:
+                known.add(os.path.join(path, name))
+                if table is db.caldbs:
+                    known.add(os.path.join(path, name)+'.lock')
+            results.close()
+    return known
+
+
+def find_orphans(db, basedir):
+    """Find files below a directory that the database doesn't
+        refer to.
+
+        Inputs:
+            db: A Database object.
+            basedir: The directory to search.
+
+        Output:
+            orphans: A generator of file paths.
+    """
+    known = get_known_paths(db)
+    for dirpath, dirnames, filenames in os.walk(basedir):
+        for fn in filenames:
+            path = os.path.join(dirpath, fn)
+            if path not in known:
+                yield path
+
+
+def main():
+    db = database.Database()
+    pool = multiprocessing.pool.ThreadPool(args.nthreads)
+    counts = {'ok': 0, 'mismatch': 0, 'missing': 0, 'unchanged': 0}
+    last_id = 0
+    try:
+        while True:
+            rows = get_files(db, after_id=last_id, limit=args.batch_size)
+            if not rows:
+                break
+            last_id = rows[-1]['file_id']
+            states = pool.map(audit_file, rows)
+            for row, state in zip(rows, states):
+                if state.get('unchanged'):
+                    counts['unchanged'] += 1
+                counts[state['status']] += 1
+                if state['status'] != 'ok':
+                    print "%s\t%d\t%s\t%s" % \
+                            (state['status'].upper(), row['file_id'],
+                             os.path.join(row['filepath'], row['filename']),
+                             state['note'])
+            if not args.dry_run:
+                record_states(db, states)
+            utils.print_info("Audited files up to ID %d" % last_id, 2)
+    finally:
+        pool.close()
+        pool.join()
+
+    norphans = 0
+    if args.find_orphans:
+        for path in find_orphans(db, args.orphan_dir):
+            print "ORPHAN\t-\t%s\t-" % path
+            norphans += 1
+
+    utils.print_info("Audited %d files: %d OK (%d unchanged since last "
+                     "audit), %d mismatched, %d missing" %
+                     (sum(counts[key] for key in ('ok', 'mismatch', 'missing')),
+                      counts['ok'], counts['unchanged'], counts['mismatch'],
+                      counts['missing']), 1)
+    if args.find_orphans:
+        utils.print_info("Found %d orphaned files below %s" %
+                         (norphans, args.orphan_dir), 1)
+
+
+if __name__ == '__main__':
+    parser = utils.DefaultArguments(description="Verify that files on disk "
+                                                "match the database.")
+    parser.add_argument("-j", "--nthreads", dest='nthreads', type=int,
+                        default=4,
+                        help="The number of files to hash concurrently. "
+                             "(Default: 4)")
+    parser.add_argument("--batch-size", dest='batch_size', type=int,
+                        default=1000,
+                        help="The number of database rows to audit at "
+                             "a time. (Default: 1000)")
+    parser.add_argument("-n", "--dry-run", dest='dry_run',
+                        action='store_true',
+                        help="Do not record audit results in the "
+                             "database. (Default: record results)")
+    parser.add_argument("--find-orphans", dest='find_orphans',
+                        action='store_true',
+                        help="Also report files below the output "
+                             "directory that the database doesn't "
+                             "refer to. (Default: don't look for orphans)")
+    parser.add_argument("--orphan-dir", dest='orphan_dir', type=str,
+                        default=config.output_location,
+                        help="The directory to search for orphans. "
+                             "(Default: %s)" % config.output_location)
+    args = parser.parse_args()
+    main()
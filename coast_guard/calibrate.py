@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 import datetime
 import os.path
+import fcntl
+import shutil
+import tempfile
 
 from coast_guard import config
 from coast_guard import utils
@@ -8,6 +11,75 @@ from coast_guard import errors
 from coast_guard import database
 
 
+class CaldbLock(object):
+    """A lock on a calibrator database file. The lock is held
+        on a separate '.lock' file using POSIX (fcntl) locks,
+        so it is respected by all processes, including those on
+        other hosts if the filesystem supports locking (e.g. NFS
+        with lockd).
+
+        Processes that only read the database should hold a
+        shared lock. Processes that modify it should hold an
+        exclusive lock.
+    """
+    def __init__(self, caldbpath, exclusive=False):
+        """Constructor for CaldbLock objects.
+
+            Inputs:
+                caldbpath: The path to the calibrator database file.
+                exclusive: If True, hold an exclusive lock. Otherwise
+                    hold a shared lock. (Default: False)
+        """
+        self.lockfn = caldbpath+'.lock'
+        self.exclusive = exclusive
+        self.lockfile = None
+
+    def acquire(self):
+        """Acquire the lock, waiting until it is available.
+
+            Inputs:
+                None
+
+            Outputs:
+                None
+        """
+        if self.exclusive:
+            locktype = fcntl.LOCK_EX
+        else:
+            locktype = fcntl.LOCK_SH
+        self.lockfile = open(self.lockfn, 'a+')
+        try:
+            fcntl.lockf(self.lockfile, locktype)
+        except:
+            self.lockfile.close()
+            self.lockfile = None
+            raise
+        utils.print_debug("Acquired %s lock on %s" %
+                          (self.exclusive and 'exclusive' or 'shared',
+                           self.lockfn), 'calibrate')
+
+    def release(self):
+        """Release the lock.
+
+            Inputs:
+                None
+
+            Outputs:
+                None
+        """
+        if self.lockfile is not None:
+            fcntl.lockf(self.lockfile, fcntl.LOCK_UN)
+            self.lockfile.close()
+            self.lockfile = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
 def get_caldb(db, sourcename):
     """Given a sourcename return the corresponding entry in the
         caldb table.
@@ -41,14 +113,190 @@ def get_caldb(db, sourcename):
                                    (len(rows), name))
 
 
+def read_caldb(caldbpath, basedir):
+    """Read a calibrator database file written by 'pac -w'.
+
+        Inputs:
+            caldbpath: The path to the calibrator database file.
+            basedir: The directory 'pac' was run in when the
+                database was written. Relative search paths
+                are interpreted relative to this directory.
+
+        Outputs:
+            path: The directory the database's entries are relative to.
+            header: A list of the database's non-entry lines.
+            entries: A dictionary mapping the absolute path of each
+                calibrator file in the database to its entry line.
+    """
+    path = basedir
+    header = []
+    entries = {}
+    with open(caldbpath, 'r') as ff:
+        for line in ff:
+            line = line.rstrip('\n')
+            if not line.strip() or line.startswith('#') or \
+                    line.startswith('Pulsar::Database'):
+                header.append(line)
+            elif line.split()[0] == 'path':
+                path = os.path.join(basedir, line.split(None, 1)[1].strip())
+                header.append(line)
+            else:
+                calfn = os.path.normpath(os.path.join(path, line.split()[0]))
+                entries[calfn] = line
+    return path, header, entries
+
+
+def make_caldb_entries(calfns, ext='.pcal.T'):
+    """Create calibrator database entries for the given files.
+        Only these files are read by 'pac'.
+
+        Inputs:
+            calfns: A list of calibrator file names.
+            ext: The extension of calibrator files. (Default: .pcal.T)
+
+        Outputs:
+            header: A list of the database's non-entry lines, other
+                than its search path.
+            entries: A dictionary mapping the absolute path of each
+                calibrator file to its entry line, without the
+                leading file name.
+    """
+    tmpdir = tempfile.mkdtemp(prefix='caldb_')
+    try:
+        # Link the files into an otherwise empty directory
+        # so 'pac' doesn't scan other calibrator files
+        bybase = {}
+        for calfn in calfns:
+            base = os.path.basename(calfn)
+            if base in bybase:
+                raise errors.CalibrationError("Multiple calibrator files "
+                                              "named %s." % base)
+            bybase[base] = os.path.abspath(calfn)
+            os.symlink(bybase[base], os.path.join(tmpdir, base))
+        tmpdb = os.path.join(tmpdir, 'new.caldb.txt')
+        utils.execute(['pac', '-w', '-u', ext, '-k', tmpdb], dir=tmpdir)
+        path, header, tmpentries = read_caldb(tmpdb, tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
+    entries = {}
+    for tmpfn, line in tmpentries.iteritems():
+        base = os.path.basename(tmpfn)
+        if base not in bybase:
+            raise errors.CalibrationError("Unexpected calibrator database "
+                                          "entry (%s)." % base)
+        entries[bybase[base]] = line.split(None, 1)[1]
+    if len(entries) != len(bybase):
+        raise errors.CalibrationError("Calibrator database entries could "
+                                      "only be created for %d of %d files." %
+                                      (len(entries), len(bybase)))
+    # The search path refers to the temporary directory
+    header = [line for line in header if not line.startswith('path')]
+    return header, entries
+
+
+def __write_caldb_lines(caldbpath, path, lines, entries):
+    """Write a calibrator database file. The file is replaced
+        atomically so it can be read while being updated.
+
+        Inputs:
+            caldbpath: The path to the calibrator database file.
+            path: The directory the database's entries are relative to.
+            lines: The lines to write before the new entries.
+            entries: A dictionary mapping the absolute path of
+                calibrator files to their entry lines, without
+                the leading file name.
+
+        Outputs:
+            None
+    """
+    lines = list(lines)
+    for calfn, entry in sorted(entries.iteritems()):
+        relfn = os.path.relpath(calfn, path)
+        if relfn.startswith(os.pardir):
+            raise errors.CalibrationError("Calibrator file is not within "
+                                          "the database's search path "
+                                          "(%s)." % calfn)
+        lines.append("%s %s" % (relfn, entry))
+    fd, tmpfn = tempfile.mkstemp(dir=os.path.dirname(caldbpath),
+                                 suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as ff:
+            ff.write("\n".join(lines)+"\n")
+        os.rename(tmpfn, caldbpath)
+    except:
+        os.remove(tmpfn)
+        raise
+
+
+def write_caldb(caldbpath, basedir, calfns):
+    """Write a calibrator database containing exactly the given
+        calibrator files. The same files are used to check the
+        database's consistency when it is appended to
+        (see 'append_to_caldb').
+
+        Inputs:
+            caldbpath: The path to the calibrator database file.
+            basedir: The directory the database's entries are
+                relative to. All calibrator files must be within it.
+            calfns: The list of all calibrator files that belong
+                in the database.
+
+        Output:
+            numentries: The number of entries written.
+    """
+    calfns = set([os.path.abspath(calfn) for calfn in calfns])
+    header, entries = make_caldb_entries(sorted(calfns))
+    basedir = os.path.abspath(basedir)
+    __write_caldb_lines(caldbpath, basedir,
+                        header + ["path %s" % basedir], entries)
+    return len(entries)
+
+
+def append_to_caldb(caldbpath, basedir, calfns):
+    """Add entries for new calibrator files to an existing
+        calibrator database without rebuilding it.
+
+        The database is checked for consistency first:
+        all of its entries must refer to files in 'calfns'
+        that still exist.
+
+        Inputs:
+            caldbpath: The path to the calibrator database file.
+            basedir: The directory 'pac' is run in to build the database.
+            calfns: The list of all calibrator files that belong
+                in the database.
+
+        Output:
+            numnew: The number of entries added.
+    """
+    path, header, entries = read_caldb(caldbpath, basedir)
+    calfns = set([os.path.abspath(calfn) for calfn in calfns])
+    for calfn in entries:
+        if (calfn not in calfns) or (not os.path.isfile(calfn)):
+            raise errors.CalibrationError("Calibrator database entry "
+                                          "is stale (%s)." % calfn)
+    newfns = sorted(calfns.difference(entries))
+    if not newfns:
+        return 0
+    newentries = make_caldb_entries(newfns)[1]
+    __write_caldb_lines(caldbpath, path,
+                        header + [entries[calfn] for calfn in sorted(entries)],
+                        newentries)
+    return len(newfns)
+
+
 def update_caldb(db, sourcename, force=False):
     """Check for new calibrator scans. If found update the calibrator database.
 
+        New calibrator scans are appended to the existing database.
+        The database is only rebuilt from scratch if it doesn't
+        exist, it fails the consistency check, or if requested.
+
         Inputs:
             db: A Database object.
             sourcename: The name of the source to match.
                 (NOTE: '_R' will be removed from the sourcename, if present)
-            force: Forcefully update the caldb
+            force: Forcefully rebuild the caldb
         
         Outputs:
             caldb: The path to the updated caldb.
@@ -59,91 +307,180 @@ def update_caldb(db, sourcename, force=False):
 
     # Get the caldb
     caldb = get_caldb(db, name)
+    outdir = os.path.join(config.output_location, 'caldbs')
+    outfn = '%s.caldb.txt' % name.upper()
     if caldb is None:
-        lastupdated = datetime.datetime.min
-        outdir = os.path.join(config.output_location, 'caldbs')
         try:
             os.makedirs(outdir)
         except OSError:
             # Directory already exists
             pass
-        outfn = '%s.caldb.txt' % name.upper()
         outpath = os.path.join(outdir, outfn)
-        insert_new = True
-        values = {'sourcename': name,
-                  'caldbpath': outdir,
-                  'caldbname': outfn}
     else:
-        lastupdated = caldb['last_modified']
         outpath = os.path.join(caldb['caldbpath'], caldb['caldbname'])
-        insert_new = False
-        values = {}
 
-    with db.transaction() as conn:
-        if not insert_new:
-            # Mark update of caldb as in-progress
-            update = db.caldbs.update().\
-                        values(status='updating',
-                                last_modified=datetime.datetime.now()).\
-                        where(db.caldbs.c.caldb_id == caldb['caldb_id'])
-            conn.execute(update)
-
-        select = db.select([db.files],
-                    from_obj=[db.files.\
-                        outerjoin(db.obs,
-                            onclause=db.files.c.obs_id ==
-                                    db.obs.c.obs_id)]).\
-                    where((db.files.c.status.in_(['new', 'done'])) &
-                            (db.files.c.stage == 'calibrated') &
-                            (db.obs.c.obstype == 'cal') & 
-                            (db.obs.c.sourcename == ('%s_R' % name)))
-        results = conn.execute(select)
-        rows = results.fetchall()
-        results.close()
+    with CaldbLock(outpath, exclusive=True):
+        if caldb is None:
+            # The caldb might have been created while waiting for the lock
+            caldb = get_caldb(db, name)
+        if caldb is None:
+            insert_new = True
+            values = {'sourcename': name,
+                      'caldbpath': outdir,
+                      'caldbname': outfn}
+        else:
+            insert_new = False
+            values = {}
 
-        numnew = 0
-        for row in rows:
-            if row['added'] > lastupdated:
-                numnew += 1
+        with db.transaction() as conn:
+            if not insert_new:
+                # Mark update of caldb as in-progress
+                update = db.caldbs.update().\
+                            values(status='updating',
+                                    last_modified=datetime.datetime.now()).\
+                            where(db.caldbs.c.caldb_id == caldb['caldb_id'])
+                conn.execute(update)
 
-        utils.print_info("Found %d suitable calibrators for %s. "
-                         "%d are new." %
-                         (len(rows), name, numnew), 2)
+            select = db.select([db.files],
+                        from_obj=[db.files.\
+                            outerjoin(db.obs,
+                                onclause=db.files.c.obs_id ==
+                                        db.obs.c.obs_id)]).\
+                        where((db.files.c.status.in_(['new', 'done'])) &
+                                (db.files.c.stage == 'calibrated') &
+                                (db.obs.c.obstype == 'cal') & 
+                                (db.obs.c.sourcename == ('%s_R' % name)))
+            results = conn.execute(select)
+            rows = results.fetchall()
+            results.close()
 
-        values['numentries'] = len(rows)
+            calfns = [os.path.join(row['filepath'], row['filename'])
+                      for row in rows]
+            values['numentries'] = len(rows)
+            basecaldir = os.path.join(config.output_location,
+                                        name.upper()+"_R")
+            numnew = len(rows)
+            rebuild = force or insert_new or (not os.path.isfile(outpath))
 
-        try:
-            if numnew or force:
-                # Create an updated version of the calibrator database 
-                basecaldir = os.path.join(config.output_location,
-                                            name.upper()+"_R")
-                utils.execute(['pac', '-w', '-u', '.pcal.T', '-k', outpath],
-                                dir=basecaldir)
-        except:
-            #raise
-            values['status'] = 'failed'
-            if insert_new:
-                action = db.caldbs.insert()
-            else:
-                action = db.caldbs.update().\
-                            values(note='%d new entries added' % numnew,
-                                    last_modifed=datetime.datetime.now()).\
-                            where(db.caldbs.c.caldb_id == caldb['caldb_id'])
-            conn.execute(action, values)
-        else:
-            if insert_new:
-                action = db.caldbs.insert()
+            try:
+                if not rebuild:
+                    try:
+                        numnew = append_to_caldb(outpath, basecaldir, calfns)
+                    except errors.CalibrationError as exc:
+                        utils.print_info("Calibrator database for %s is "
+                                         "inconsistent (%s). Rebuilding it." %
+                                         (name, exc.get_message()), 2)
+                        numnew = len(rows)
+                        rebuild = True
+                if rebuild:
+                    # Create an updated version of the calibrator database
+                    # from the same files used to check its consistency
+                    write_caldb(outpath, basecaldir, calfns)
+                utils.print_info("Found %d suitable calibrators for %s. "
+                                 "%d are new." %
+                                 (len(rows), name, numnew), 2)
+            except:
+                #raise
+                values['status'] = 'failed'
+                if insert_new:
+                    action = db.caldbs.insert()
+                else:
+                    action = db.caldbs.update().\
+                                values(note='%d new entries added' % numnew,
+                                        last_modified=datetime.datetime.now()).\
+                                where(db.caldbs.c.caldb_id == caldb['caldb_id'])
+                conn.execute(action, values)
             else:
-                action = db.caldbs.update().\
-                            values(status='ready',
-                                    note='%d new entries added' % numnew,
-                                    last_modified=datetime.datetime.now()).\
-                            where(db.caldbs.c.caldb_id == caldb['caldb_id'])
-            conn.execute(action, values)
+                if insert_new:
+                    action = db.caldbs.insert()
+                else:
+                    action = db.caldbs.update().\
+                                values(status='ready',
+                                        note='%d new entries added' % numnew,
+                                        last_modified=datetime.datetime.now()).\
+                                where(db.caldbs.c.caldb_id == caldb['caldb_id'])
+                conn.execute(action, values)
     return outpath
 
 
-def calibrate(infn, caldbpath, nchans=None):
+def get_polcal_match(psrobs, calobs):
+    """Return a sqlalchemy clause matching pulsar observations
+        with the calibrator scans that 'pac' would use to calibrate
+        them. This is the single definition of a suitable calibrator
+        scan, used both to choose calibrators and to decide which
+        observations can be calibrated.
+
+        'pac's matching criteria for polarization calibrators are
+        reproduced: the calibrator scan must be of the same source,
+        have the same receiver and backend (observations with an
+        unknown receiver are never matched), its centre frequency
+        and bandwidth must agree within the tolerances
+        'calmatch_freq_tolerance' and 'calmatch_bw_tolerance'
+        (in MHz), and it must have been observed within the
+        PSRCHIVE 'Database::short_time_scale' of the observation.
+
+        Inputs:
+            psrobs: The obs table (or an alias) for pulsar observations.
+            calobs: The obs table (or an alias) for calibrator scans.
+
+        Output:
+            clause: The sqlalchemy clause.
+    """
+    psrchive_cfg = utils.get_psrchive_configs()
+    validity_days = float(psrchive_cfg.get("Database::short_time_scale",
+                                           120))/(60.0*24.0)
+    freq_tol = getattr(config, 'calmatch_freq_tolerance', 0.1)
+    bw_tol = getattr(config, 'calmatch_bw_tolerance', 0.1)
+    return ((calobs.c.obstype == 'cal') &
+                (calobs.c.sourcename == (psrobs.c.sourcename + "_R")) &
+                (calobs.c.rcvr == psrobs.c.rcvr) &
+                (calobs.c.backend == psrobs.c.backend) &
+                calobs.c.start_mjd.between(psrobs.c.start_mjd-validity_days,
+                                           psrobs.c.start_mjd+validity_days) &
+                calobs.c.bw.between(psrobs.c.bw-bw_tol,
+                                    psrobs.c.bw+bw_tol) &
+                calobs.c.freq.between(psrobs.c.freq-freq_tol,
+                                      psrobs.c.freq+freq_tol))
+
+
+def get_closest_calibrator(db, obs_id):
+    """Find the calibrator scan in the calibrator database that
+        'pac' would use to calibrate the given observation: the
+        matching scan (see 'get_polcal_match') closest in time.
+
+        Inputs:
+            db: A Database object.
+            obs_id: The ID number of the pulsar observation.
+
+        Output:
+            calrow: The file row of the calibrator scan, or None
+                if there is no suitable calibrator scan.
+    """
+    psrobs = db.obs.alias('psrobs')
+    calobs = db.obs.alias('calobs')
+    with db.transaction() as conn:
+        select = db.select([db.files,
+                            calobs.c.start_mjd,
+                            psrobs.c.start_mjd.label('psr_start_mjd')],
+                    from_obj=[psrobs.\
+                        join(calobs,
+                            onclause=get_polcal_match(psrobs, calobs)).\
+                        join(db.files,
+                            onclause=db.files.c.obs_id == calobs.c.obs_id)]).\
+                    where((psrobs.c.obs_id == obs_id) &
+                            (db.files.c.status.in_(['new', 'done'])) &
+                            (db.files.c.stage == 'calibrated'))
+        results = conn.execute(select)
+        rows = results.fetchall()
+        results.close()
+    if not rows:
+        return None
+    return min(rows, key=lambda row: (abs(row['start_mjd'] -
+                                          row['psr_start_mjd']),
+                                      row['file_id']))
+
+
+def calibrate(infn, caldbpath, nchans=None, calrow=None):
     """Calibrate a pulsar scan using the calibrator database provided.
 
         Inputs:
@@ -152,21 +489,34 @@ def calibrate(infn, caldbpath, nchans=None):
             nchans: Scrunch the input file to this many
                 channels before calibrating. 
                 (Default: don't scrunch)
+            calrow: The file row of the calibrator scan to use
+                (see 'get_closest_calibrator'). If provided, the
+                calibrator is used directly without searching the
+                calibrator database.
+                (Default: let 'pac' search the calibrator database)
 
         Outputs:
             polcalfn: The name of the polarization calibrator used.
     """
-    if not os.path.isfile(caldbpath):
-        raise errors.DataReductionFailed("Calibrator database "
-                                         "file not found (%s)." % caldbpath)
     if nchans is not None:
         preproc = ['-j', 'F %d' % nchans]
     else:
         preproc = []
+    if calrow is not None:
+        calfn = os.path.join(calrow['filepath'], calrow['filename'])
+        utils.execute(['pac', '-A', calfn, infn] + preproc)
+        utils.log_message("Polarization calibrator used:"
+                          "\n    %s" % calfn, 'info')
+        return calfn
+
+    if not os.path.isfile(caldbpath):
+        raise errors.DataReductionFailed("Calibrator database "
+                                         "file not found (%s)." % caldbpath)
     # Now calibrate, scrunching to the appropriate 
     # number of channels
-    stdout, stderr = utils.execute(['pac', '-d', caldbpath,
-                                    infn] + preproc)
+    with CaldbLock(caldbpath):
+        stdout, stderr = utils.execute(['pac', '-d', caldbpath,
+                                        infn] + preproc)
     
     # Get name of calibrator used
     calfn = None
@@ -201,7 +551,7 @@ def main():
     for fn in args.files:
         if args.caldb is None: 
             arf = utils.ArchiveFile(fn)
-            caldb = update_caldb(db, arf['name'], force=True)
+            caldb = update_caldb(db, arf['name'])
         calfn = calibrate(fn, caldb)
         #print "    Output calibrated file: %s" % calfn
 
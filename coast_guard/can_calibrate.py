@@ -64,10 +64,12 @@ def get_files(psrnames, retry=False):
     return rows
 
 
-def retry(db, file_id):
+def retry(db, file_ids):
+    if not file_ids:
+        return
     with db.transaction() as conn:
         update = db.files.update().\
-                    where(db.files.c.file_id == file_id).\
+                    where(db.files.c.file_id.in_(file_ids)).\
                     values(status='new',
                            last_modified=datetime.datetime.now())
         conn.execute(update)
@@ -80,10 +82,15 @@ def main():
     psrnameset = set([row['sourcename'] for row in rows])
     utils.sort_by_keys(rows, args.sortkeys)
     db = database.Database()
+    # Find potential calibrator scans for all observations at once
+    allcalscans = reduce_data.get_all_potential_polcal_scans(db,
+                            [row['obs_id'] for row in rows
+                             if row['obstype'] == 'pulsar'])
+    toretry = []
     with db.transaction() as conn:
         for row in rows:
             if row['obstype'] == 'pulsar':
-                calscans = reduce_data.get_potential_polcal_scans(db, row['obs_id'])
+                calscans = allcalscans[row['obs_id']]
                 cancal = bool(calscans)
             sys.stdout.write(args.fmt.decode('string-escape') % row)
             if row['obstype'] == 'pulsar':
@@ -105,13 +112,14 @@ def main():
                         cancal = False
                         utils.print_info("Calibration of file %d has previously failed. Will _not_ retry." % row['file_id'], 1)
                 if (cancal and (row['status'] != 'failed')) or (not cancal and (row['status'] == 'calfail')):
-                    retry(db, row['file_id'])
+                    toretry.append(row['file_id'])
                     utils.print_info("Will retry calibration of file %d" % row['file_id'], 1)
         if args.retry:
+            retry(db, toretry)
             for name in psrnameset:
                 try:
                     reduce_data.reattempt_calibration(db, name)
-                    calibrate.update_caldb(db, name, force=True)
+                    calibrate.update_caldb(db, name)
                 except:
                     pass
 
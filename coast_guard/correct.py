@@ -5,6 +5,11 @@ import glob
 import datetime
 import pprint
 import shutil
+import bisect
+import hashlib
+import tempfile
+import cPickle
+import collections
 
 import numpy as np
 
@@ -44,6 +49,15 @@ OBSLOG_FIELDS = (('localdate', rs.utils.parse_datestr),
                  ('catalog_decstr', str))
 
 
+# Frequency range (in MHz) of the P200-3 receiver's response
+P200_RESPONSE = (1285.0, 1437.0)
+
+# In-process cache of parsed observing log files, keyed by file name.
+# The least recently used files are dropped when there are more
+# than OBSLOG_CACHE_SIZE.
+OBSLOG_CACHE = collections.OrderedDict()
+OBSLOG_CACHE_SIZE = 64
+
 RCVR_INFO = {'P217-3': 'rcvr:name=P217-3,rcvr:hand=-1,rcvr:basis=cir',
              'S110-1': 'rcvr:name=S110-1,rcvr:hand=-1,rcvr:basis=cir',
              'P200-3': 'rcvr:name=P200-3,rcvr:hand=-1,rcvr:basis=cir',
@@ -65,6 +79,39 @@ def read_receiver_file(fn='lband_receivers.txt'):
     return rcvrs
 
 
+def get_receiver_from_map(mjd_to_receiver, mjd):
+    """Given an MJD to receiver mapping (see 'read_receiver_file')
+        get the name of the L-band receiver used on the given date.
+
+        Inputs:
+            mjd_to_receiver: A dictionary mapping integer MJDs to
+                receiver codes ('1' for the single-pixel receiver,
+                '7' for the 7-beam receiver).
+            mjd: The MJD of the observation.
+
+        Output:
+            rcvr: The name of the receiver.
+    """
+    imjd = int(mjd)
+    rcvr = mjd_to_receiver.get(imjd, 'X')
+    if rcvr == '?':
+        raise errors.HeaderCorrectionError("Using MJD to receiver mapping "
+                                           "but receiver is unknown (%s)" % rcvr)
+    elif rcvr == 'X':
+        raise errors.HeaderCorrectionError("Using MJD to receiver mapping "
+                                           "but MJD (%d) has no entry" % imjd)
+    elif rcvr == '1':
+        # Single pixel receiver
+        rcvr = "P200-3"
+    elif rcvr == '7':
+        # 7-beam receiver
+        rcvr = "P217-3"
+    else:
+        raise errors.HeaderCorrectionError("Using MJD to receiver mapping "
+                                           "but receiver is invalid (%s)" % rcvr)
+    return rcvr
+
+
 def get_coordinates(arf, obsinfo=None, tolerant=False):
     """Given an archive file try to compute the telescope coordinates
         from the observation log.
@@ -89,33 +136,48 @@ def get_coordinates(arf, obsinfo=None, tolerant=False):
     return rastr, decstr
 
 
-def determine_receiver(arf, use_weights=True):
+def determine_receiver(arf, use_weights=True, mjd_to_receiver=None):
     """Given an ArchiveFile object determin the Effelsberg
-        reciver name.
+        reciver name. For L-band, if an MJD to receiver mapping is
+        provided the receiver is looked up by observation date.
+        Otherwise the data are loaded and the receiver is determined
+        from the presence of signal outside the P200-3 receiver's
+        response.
 
         Input:
             arf: An ArchiveFile object.
             use_weights: If True, use weights as-is. If not reset weights to be uniform.
+                (NOTE: Weights are reset after time-scrunching.)
                 (Default: use weights as-is)
+            mjd_to_receiver: An MJD to receiver mapping used to determine
+                L-band receivers (see 'read_receiver_file').
+                (Default: Don't use a mapping)
 
         Output:
             rcvr: The name of the receiver.
     """
     if arf['band'] == 'Lband':
         # L-band
-        ar = arf.get_archive()
+        if mjd_to_receiver is not None:
+            rcvr = get_receiver_from_map(mjd_to_receiver, arf['mjd'])
+            utils.print_debug("Receiver determined from observation "
+                              "date (MJD %g): %s" % (arf['mjd'], rcvr),
+                              'correct')
+            return rcvr
+        # Work on a time-scrunched copy so the loaded archive can
+        # still be corrected, without copying every sub-integration
+        ar = arf.get_archive().total()
         if not use_weights:
             ar.uniform_weight(1.0)
         nchan = ar.get_nchan()
         # Scrunch
         ar.pscrunch()
-        ar.tscrunch()
         # Get the relevant data
         chnwts = clean_utils.get_chan_weights(ar).astype(bool)
         stddevs = ar.get_data().squeeze().std(axis=1)
         freqs = clean_utils.get_frequencies(ar)
         # Outside P200-3 receiver's response
-        iout = (freqs < 1285.0) | (freqs > 1437.0)
+        iout = (freqs < P200_RESPONSE[0]) | (freqs > P200_RESPONSE[1])
         if np.sum(iout) < 5:
             raise errors.HeaderCorrectionError("Cannot determine L-band "
                                                "receiver. Too few channels "
@@ -147,11 +209,13 @@ def determine_receiver(arf, use_weights=True):
 
 
 def get_correction_string(arfn, obsinfo=None, backend='asterix', 
-                          receiver=None, fixcoords=False):
+                          receiver=None, fixcoords=False,
+                          mjd_to_receiver=None):
     """Get psredit command string that will correct the file header.
 
         Input:
-            arfn: The name of the input archive file.
+            arfn: The name of the input archive file, or an
+                ArchiveFile object.
             obsinfo: A dictionary of observing log information to use.
                 (Default: search observing logs for matching entry)
             backend: Override backend name with this value.
@@ -160,6 +224,9 @@ def get_correction_string(arfn, obsinfo=None, backend='asterix',
                 (Default: Determine receiver automatically)
             fixcoords: Force fixing of coordinates.
                 (Default: Don't bother if they seem to be correct)
+            mjd_to_receiver: An MJD to receiver mapping used to determine
+                L-band receivers (see 'read_receiver_file').
+                (Default: Don't use a mapping)
 
         Output:
             corrstr: The parameter string of corrections used with psredit.
@@ -167,9 +234,12 @@ def get_correction_string(arfn, obsinfo=None, backend='asterix',
     """
     note = ""
     # Load archive
-    arf = utils.ArchiveFile(arfn)
+    if isinstance(arfn, utils.ArchiveFile):
+        arf = arfn
+    else:
+        arf = utils.ArchiveFile(arfn)
     if receiver is None:
-        rcvr = determine_receiver(arf)
+        rcvr = determine_receiver(arf, mjd_to_receiver=mjd_to_receiver)
     elif receiver in ('P217-3', 'P200-3', 'S110-1', 'S60-2', 'S36-5'):
         rcvr = receiver
     else:
@@ -221,11 +291,17 @@ def get_correction_string(arfn, obsinfo=None, backend='asterix',
 
 
 def correct_header(arfn, obsinfo=None, outfn=None, 
-                   backend='asterix', receiver=None):
-    """Correct header of asterix data in place.
+                   backend='asterix', receiver=None,
+                   mjd_to_receiver=None):
+    """Correct header of asterix data. The corrections are
+        applied to the archive in memory, using the psrchive
+        python bindings, and the corrected archive is written once.
 
         Input:
-            arfn: The name of the input archive file.
+            arfn: The name of the input archive file, or an
+                ArchiveFile object. If an ArchiveFile object is
+                given its archive is corrected in place, and left
+                loaded.
             obsinfo: A dictionary of observing log information to use.
                 (Default: search observing logs for matching entry)
             outfn: Output file name.
@@ -234,28 +310,34 @@ def correct_header(arfn, obsinfo=None, outfn=None,
                 (Default: asterix)
             receiver: Override receiver name with this value.
                 (Default: Determine receiver automatically)
+            mjd_to_receiver: An MJD to receiver mapping used to determine
+                L-band receivers (see 'read_receiver_file').
+                (Default: Don't use a mapping)
 
         Output:
             corrfn: The name of the corrected file.
             corrstr: The parameter string of corrections used with psredit.
             note: A note about header correction
     """
-    corrstr, note = get_correction_string(arfn, obsinfo, 
-                                          receiver=receiver, 
+    if isinstance(arfn, utils.ArchiveFile):
+        arf = arfn
+    else:
+        arf = utils.ArchiveFile(arfn)
+    corrstr, note = get_correction_string(arf, obsinfo, 
+                                          receiver=receiver,
+                                          mjd_to_receiver=mjd_to_receiver,
                                           backend=backend)
-    # Correct the file using 'psredit'
-    utils.execute(['psredit', '-e', 'corr', '-c', corrstr, arfn],
-                  stderr=open(os.devnull))
-    # Assume the name of the corrected file
-    corrfn = os.path.splitext(arfn)[0]+".corr"
-    # Confirm that our assumed file name is accurate
-    if not os.path.isfile(corrfn):
-        raise errors.HeaderCorrectionError("The corrected file (%s) does not " \
-                                           "exist!" % corrfn)
+    # Correct the archive in memory (equivalent to 'psredit -e corr')
+    corrfn = os.path.splitext(arf.fn)[0]+".corr"
+    try:
+        corrarf = utils.edit_archive(arf, edits=corrstr.split(','),
+                                     outfn=corrfn)
+    except Exception as exc:
+        raise errors.HeaderCorrectionError("Could not correct header of "
+                                           "%s (%s)" % (arf.fn, str(exc)))
     # Rename output file
     if outfn is not None:
-        arf = utils.ArchiveFile(corrfn)
-        fn = outfn % arf
+        fn = outfn % corrarf
         shutil.move(corrfn, fn)
         corrfn = fn
     return corrfn, corrstr, note
@@ -297,6 +379,10 @@ def get_obslog_entry(arf, tolerant=False):
     obsdt_utc, names = __prep_obslog_search(arf, tolerant)
 
     logentries = __obslog_db_match(obsdt_utc, names)
+    if not logentries:
+        utils.print_info('No matches found in obslog DB. Searching imported '
+                         'text files.', 1)
+        logentries = __protinfo_db_match(obsdt_utc, names)
     if not logentries:
         utils.print_info('No matches found in obslog DB. Searching text files.', 1)
         logentries = __obslog_file_match(obsdt_utc, names)
@@ -359,11 +445,20 @@ def __obslog_db_match(obsdt_utc, names):
     """
     db = database.Database('obslog')
 
-    utcstart_col = sa.cast(db.obsinfo.c.obstimestamp, sa.DateTime)
+    # Use the indexed native timestamp column. Entries imported
+    # without it fall back to the string timestamp. (They can be
+    # filled in by running 'upgrade_tables.py --db obslog'.)
+    obsutc_col = db.obsinfo.c.obsutc
+    obststamp_col = sa.cast(db.obsinfo.c.obstimestamp, sa.DateTime)
+    utcstart_col = sa.func.coalesce(obsutc_col, obststamp_col)
 
     # Find entries within +- 1 day of observation start time
     start = obsdt_utc - datetime.timedelta(days=1)
     end = obsdt_utc + datetime.timedelta(days=1)
+    # Keep the range on 'obsutc' separate so its index can be used
+    in_range = ((obsutc_col >= start) & (obsutc_col <= end)) | \
+               ((obsutc_col == None) & (obststamp_col >= start) &
+                (obststamp_col <= end))
     with db.transaction() as conn:
         select = db.select([db.obsinfo.c.object.label('name'), 
                             (db.obsinfo.c.lst/3600.0).label('lststart'), 
@@ -373,8 +468,7 @@ def __obslog_db_match(obsdt_utc, names):
                             db.obsinfo.c.scan.label('scannum'),
                             db.obsinfo.c.lon, 
                             db.obsinfo.c.lat]).\
-                    where(db.obsinfo.c.object.in_(names) & (utcstart_col >= start) & 
-                          (utcstart_col <= end))
+                    where(db.obsinfo.c.object.in_(names) & in_range)
         result = conn.execute(select)
         rows = result.fetchall()
         result.close()
@@ -410,6 +504,127 @@ def __obslog_db_match(obsdt_utc, names):
     return logentries
 
 
+def read_obslog_file(obslogfn):
+    """Read and parse an observing log file. Parsed files are
+        cached in memory, and pickled in the user's private cache
+        directory (see 'utils.get_cache_dir') so other processes
+        can use them. Cached entries are only
+        used if the file's modification time hasn't changed.
+
+        Input:
+            obslogfn: The observing log file name.
+
+        Output:
+            parsed: A dictionary with keys:
+                'entries': A list of (line, info) tuples, one for each
+                    valid observing log entry, in the order they appear.
+                'utcs': A sorted list of (UTC start, index into
+                    'entries') tuples.
+    """
+    mtime = os.path.getmtime(obslogfn)
+    parsed = OBSLOG_CACHE.pop(obslogfn, None)
+    if (parsed is None) or (parsed['mtime'] != mtime):
+        cachedir = utils.get_cache_dir()
+        parsed = None
+        if cachedir is not None:
+            picklefn = os.path.join(cachedir, "obslog_%s.pkl" %
+                        hashlib.md5(os.path.abspath(obslogfn)).hexdigest())
+            try:
+                with open(picklefn, 'rb') as ff:
+                    parsed = cPickle.load(ff)
+            except Exception:
+                # Missing or unreadable. It will be rebuilt.
+                parsed = None
+        if (parsed is None) or (parsed['mtime'] != mtime):
+            entries = []
+            with open(obslogfn, 'r') as obslog:
+                for line in obslog:
+                    try:
+                        entries.append((line, parse_obslog_line(line)))
+                    except errors.FormatError:
+                        # Not a valid observation log entry
+                        continue
+            utcs = sorted([(info['utcstart'], ii) for ii, (line, info)
+                           in enumerate(entries)])
+            parsed = {'mtime': mtime,
+                      'entries': entries,
+                      'utcs': utcs}
+            if cachedir is not None:
+                # Write to a temporary file first so other processes
+                # never read a partially written file
+                try:
+                    fd, tmpfn = tempfile.mkstemp(dir=cachedir,
+                                                 prefix=".obslog")
+                    with os.fdopen(fd, 'wb') as ff:
+                        cPickle.dump(parsed, ff, cPickle.HIGHEST_PROTOCOL)
+                    os.rename(tmpfn, picklefn)
+                except (IOError, OSError):
+                    utils.print_debug("Could not save parsed observing "
+                                      "log (%s)" % picklefn, 'correct')
+    OBSLOG_CACHE[obslogfn] = parsed
+    while len(OBSLOG_CACHE) > OBSLOG_CACHE_SIZE:
+        OBSLOG_CACHE.popitem(last=False)
+    return parsed
+
+
+def __protinfo_db_match(obsdt_utc, names):
+    """Find entries imported from observing log files into the
+        database (see 'import_obslogs.py') matching the given information.
+
+        Inputs:
+            obsdt_utc: The UTC datetime at the start of the observation
+            names: Object names to match
+
+        Outputs:
+            logentries: Matching log entries.
+    """
+    db = database.Database('obslog')
+    obsdate = obsdt_utc.astimezone(BERLIN_TZ).date()
+    obsutc = obsdt_utc.time()
+    obsutc_hhmm = obsutc.hour+(obsutc.minute)/60.0
+    if obsutc.second > 30:
+        delta = HOURS_PER_MIN
+    else:
+        delta = -HOURS_PER_MIN
+
+    # Observing log times are only given to the minute
+    start = obsdt_utc.replace(tzinfo=None) - datetime.timedelta(minutes=2)
+    end = obsdt_utc.replace(tzinfo=None) + datetime.timedelta(minutes=2)
+    try:
+        with db.transaction() as conn:
+            select = db.select([db.protinfo]).\
+                        where(db.protinfo.c.prefname.in_(names) &
+                              (db.protinfo.c.obsutc >= start) &
+                              (db.protinfo.c.obsutc <= end))
+            result = conn.execute(select)
+            rows = result.fetchall()
+            result.close()
+    except sa.exc.DBAPIError as exc:
+        # The table doesn't exist (e.g. it hasn't been created yet)
+        utils.print_debug("Could not search imported observing logs: %s" %
+                          str(exc), 'correct')
+        return []
+
+    logentries = []
+    for row in rows:
+        if (obsdate >= row['localdate']) and \
+                (is_close(obsutc_hhmm, row['utcstart'], 1) or \
+                 is_close(obsutc_hhmm+delta, row['utcstart'], 1)):
+            # Use the same keys as 'parse_obslog_line'
+            logentries.append({'localdate': row['localdate'],
+                               'scannum': row['scan'],
+                               'utcstart': row['utcstart'],
+                               'lststart': row['lststart'],
+                               'name': row['object'],
+                               'az': row['azim'],
+                               'alt': row['elev'],
+                               'catalog_rastr': row['catalog_rastr'],
+                               'catalog_decstr': row['catalog_decstr']})
+    utils.print_debug("Found %d matching imported obs-log entries" %
+                      len(logentries), 'correct')
+    return logentries
+
+
 def __obslog_file_match(obsdt_utc, names):
     """Find entries in observing log files matching the given information.
 
@@ -455,37 +670,46 @@ def __obslog_file_match(obsdt_utc, names):
     
     utils.print_debug('Searching obs log files:\n    %s' % 
                       "\n    ".join(tosearch), 'correct')
+    # Only entries whose UTC start is close to the observation's
+    # can match. Find them with a binary search.
+    lo = min(obsutc_hhmm, obsutc_hhmm+delta) - 1/3600.0
+    hi = max(obsutc_hhmm, obsutc_hhmm+delta) + 1/3600.0
+    parsed = [read_obslog_file(obslogfn) for obslogfn in tosearch]
     logentries = []
-    check = False
-    for obslogfn in tosearch:
-        with open(obslogfn, 'r') as obslog:
-            for line in obslog:
-                try:
-                    currinfo = parse_obslog_line(line)
-                except errors.FormatError:
-                    # Not a valid observation log entry
+    for ifile, currparsed in enumerate(parsed):
+        entries = currparsed['entries']
+        utcs = currparsed['utcs']
+        istart = bisect.bisect_left(utcs, (lo, -1))
+        iend = bisect.bisect_right(utcs, (hi, len(entries)))
+        for utc, ientry in sorted(utcs[istart:iend], key=lambda xx: xx[1]):
+            prevline, previnfo = entries[ientry]
+            # The entry following the candidate may be in the next file
+            if ientry+1 < len(entries):
+                currinfo = entries[ientry+1][1]
+            else:
+                following = [pp['entries'][0][1] for pp in parsed[ifile+1:]
+                             if pp['entries']]
+                if not following:
                     continue
-                if check:
-                    utils.print_debug("Checking obslog line:\n%s\n"
-                                      "Obs date: %s, obs log date: %s, next date: %s\n"
-                                      "Obs UTC: %f, obs log UTC: %f, next UTC: %f\n" % 
-                                      (prevline, obsdate, previnfo['localdate'], 
-                                       currinfo['localdate'], obsutc_hhmm,
-                                       previnfo['utcstart'], currinfo['utcstart']), 
-                                      'correct')
-                    if (obsdate >= previnfo['localdate']) and \
-                            (obsdate <= currinfo['localdate']) and \
-                            (is_close(obsutc_hhmm, previnfo['utcstart'], 1) or \
-                             is_close(obsutc_hhmm+delta, previnfo['utcstart'], 1)):
-                             #and (obsutc_hhmm <= currinfo['utcstart']): # Not needed anymore?
-                        utils.print_debug("Matching observing log line:\n%s" % 
-                                          prevline, 'correct')
-                        logentries.append(previnfo)
-                # Check in next iteration if observation's source name matches
-                # that of the current obslog entry
-                check = (utils.get_prefname(currinfo['name']) in names)
-                prevline = line
-                previnfo = currinfo
+                currinfo = following[0]
+            # Check if observation's source name matches
+            # that of the obslog entry
+            if utils.get_prefname(previnfo['name']) not in names:
+                continue
+            utils.print_debug("Checking obslog line:\n%s\n"
+                              "Obs date: %s, obs log date: %s, next date: %s\n"
+                              "Obs UTC: %f, obs log UTC: %f, next UTC: %f\n" % 
+                              (prevline, obsdate, previnfo['localdate'], 
+                               currinfo['localdate'], obsutc_hhmm,
+                               previnfo['utcstart'], currinfo['utcstart']), 
+                              'correct')
+            if (obsdate >= previnfo['localdate']) and \
+                    (obsdate <= currinfo['localdate']) and \
+                    (is_close(obsutc_hhmm, previnfo['utcstart'], 1) or \
+                     is_close(obsutc_hhmm+delta, previnfo['utcstart'], 1)):
+                utils.print_debug("Matching observing log line:\n%s" % 
+                                  prevline, 'correct')
+                logentries.append(previnfo)
     utils.print_debug("Found %d potentially matching obs-log entries" % len(logentries), 'correct')
     return logentries
 
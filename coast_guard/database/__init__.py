@@ -1,3 +1,4 @@
+import os
 import warnings
 import string
 import re
@@ -14,6 +15,17 @@ from coast_guard import utils
 null = lambda x: x
 toround_re = re.compile(r"_R(-?\d+)?$")
 
+# Engines created by this process, keyed by DB URL.
+# Each value is a tuple: (process ID, engine)
+ENGINES = {}
+# Engines inherited from a parent process. Their connections
+# share sockets with the parent, so they must neither be used
+# nor closed. Keeping a reference prevents them being closed
+# when garbage collected.
+INHERITED_ENGINES = []
+# DB URLs whose tables have been found to exist
+CHECKED_URLS = set()
+
 
 def fancy_getitem(self, key):
     filterfunc = null
@@ -122,6 +134,10 @@ def on_sqlite_connect(dbapi_conn, conn_rec):
 
 def get_engine(url):
     """Given a DB URL string return the corresponding DB engine.
+        Engines (and their connection pools) are created once per
+        process and URL, and are re-used afterwards. A process
+        started by forking gets new engines the first time it
+        asks for them.
 
         Input:
             url: A DB URL string.
@@ -129,8 +145,34 @@ def get_engine(url):
         Output:
             engine: The corresponding DB engine.
     """
+    pid = os.getpid()
+    if url in ENGINES:
+        engine_pid, engine = ENGINES[url]
+        if engine_pid == pid:
+            return engine
+        # The engine was created before this process was forked
+        INHERITED_ENGINES.append(engine)
+    engine = create_engine(url)
+    ENGINES[url] = (pid, engine)
+    return engine
+
+
+def create_engine(url):
+    """Given a DB URL string create a new DB engine.
+
+        Input:
+            url: A DB URL string.
+
+        Output:
+            engine: The new DB engine.
+    """
     # Create the database engine
-    engine = sa.create_engine(url)
+    kwargs = {'pool_recycle': getattr(config, 'db_pool_recycle', 3600)}
+    if not sa.engine.url.make_url(url).drivername.startswith('sqlite'):
+        # Workers only need a connection for the task they're running
+        # and one for sending heartbeats
+        kwargs['pool_size'] = getattr(config, 'db_pool_size', 2)
+    engine = sa.create_engine(url, **kwargs)
     if engine.name == 'sqlite':
         sa.event.listen(engine, "connect", on_sqlite_connect)
     sa.event.listen(engine, "before_cursor_execute",
@@ -161,12 +203,14 @@ class Database(object):
             raise errors.DatabaseError("Database (%s) is not recognized. "
                                        "Cannot connect." % db)
         self.engine = get_engine(url)
-        if not self.is_created():
-            raise errors.DatabaseError("The database (%s) does not appear " \
-                                    "to have any tables. Be sure to run " \
-                                    "'create_tables.py' before attempting " \
-                                    "to connect to the database." % \
-                                            self.engine.url.database)
+        if url not in CHECKED_URLS:
+            if not self.is_created():
+                raise errors.DatabaseError("The database (%s) does not appear " \
+                                        "to have any tables. Be sure to run " \
+                                        "'create_tables.py' before attempting " \
+                                        "to connect to the database." % \
+                                                self.engine.url.database)
+            CHECKED_URLS.add(url)
 
         # The database description (in metadata)
         self.tables = self.metadata.tables
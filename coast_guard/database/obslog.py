@@ -14,6 +14,9 @@ sa.Table('obsinfo', metadata,
          sa.Column('observer', sa.String(32), nullable=False),
          sa.Column('scan', sa.Integer, nullable=False),
          sa.Column('obstimestamp', sa.String(32), nullable=False),
+         # 'obstimestamp' as a native (UTC) datetime, so time
+         # range lookups can use an index
+         sa.Column('obsutc', sa.DateTime, nullable=True, index=True),
          sa.Column('lst', sa.Float(53), nullable=False),
          sa.Column('nobs', sa.Integer, nullable=False),
          sa.Column('nsubs', sa.Integer, nullable=False),
@@ -103,3 +106,37 @@ sa.Table('obsinfo', metadata,
          sa.Column('ctrlbuttons', sa.Integer, nullable=False),
          sa.Column('obsstatus', sa.String(8), nullable=False),
          mysql_engine='InnoDB', mysql_charset='ascii')
+
+# Define the metadata object for the protinfo table
+# This table holds the entries of the text observing log
+# ('.prot') files (see 'import_obslogs.py')
+sa.Table('protinfo', metadata,
+         sa.Column('prot_id', sa.Integer, primary_key=True,
+                   autoincrement=True, nullable=False),
+         sa.Column('object', sa.String(32), nullable=False),
+         # Preferred name of 'object' (see 'utils.get_prefname')
+         sa.Column('prefname', sa.String(32), nullable=False, index=True),
+         sa.Column('scan', sa.String(16), nullable=False),
+         sa.Column('localdate', sa.Date, nullable=False),
+         sa.Column('obsutc', sa.DateTime, nullable=False, index=True),
+         sa.Column('utcstart', sa.Float(53), nullable=False),
+         sa.Column('lststart', sa.Float(53), nullable=False),
+         sa.Column('azim', sa.Float, nullable=False),
+         sa.Column('elev', sa.Float, nullable=False),
+         sa.Column('catalog_rastr', sa.String(32), nullable=False),
+         sa.Column('catalog_decstr', sa.String(32), nullable=False),
+         sa.Column('protfn', sa.String(512), nullable=False, index=True),
+         sa.UniqueConstraint('object', 'scan', 'obsutc'),
+         mysql_engine='InnoDB', mysql_charset='ascii')
+
+# Define the metadata object for the protfiles table
+# This table records the text observing log files that
+# have been imported into 'protinfo'
+sa.Table('protfiles', metadata,
+         sa.Column('protfn', sa.String(512), primary_key=True,
+                   nullable=False),
+         sa.Column('mtime', sa.Float(53), nullable=False),
+         sa.Column('nentries', sa.Integer, nullable=False),
+         sa.Column('imported', sa.DateTime, nullable=False,
+                   default=sa.func.now()),
+         mysql_engine='InnoDB', mysql_charset='ascii')
@@ -6,6 +6,7 @@ FILE_STAGES = ['grouped', 'combined', 'corrected', 'cleaned', 'calibrated']
 OBSTYPES = ['pulsar', 'cal']
 OBSBANDS = ['Pband', 'Lband', 'Sband', 'Cband', 'Xband', 'Kband']
 CALDB_STATUSES = ['ready', 'submitted', 'updating', 'failed']
+AUDIT_STATUSES = ['ok', 'mismatch', 'missing']
 
 NOTELEN = 1024  # Number of characters for the note field
 
@@ -31,6 +32,8 @@ sa.Table('directories', metadata,
          sa.Column('status', sa.Enum(*DIRECTORY_STATUSES), nullable=False,
                    default='new'),
          sa.Column('note', sa.String(NOTELEN), nullable=True),
+         sa.Column('heartbeat', sa.DateTime, nullable=True,
+                   default=None),
          sa.Column('added', sa.DateTime, nullable=False,
                    default=sa.func.now()),
          sa.Column('last_modified', sa.DateTime, nullable=False,
@@ -135,6 +138,14 @@ sa.Table('files', metadata,
                    default=None),
          sa.Column('maskfrac', sa.Float, nullable=True,
                    default=None),
+         sa.Column('claimed_by', sa.String(64), nullable=True,
+                   default=None),
+         sa.Column('claimed_status', sa.Enum(*FILE_STATUSES), nullable=True,
+                   default=None),
+         sa.Column('heartbeat', sa.DateTime, nullable=True,
+                   default=None),
+         sa.Column('nretries', sa.Integer, nullable=True,
+                   default=0),
          sa.Column('added', sa.DateTime, nullable=False,
                    default=sa.func.now()),
          sa.Column('last_modified', sa.DateTime, nullable=False,
@@ -200,4 +211,19 @@ sa.Table('qctrl', metadata,
          sa.Column('last_modified', sa.DateTime, nullable=False,
                    default=sa.func.now()),
          mysql_engine='InnoDB', mysql_charset='ascii')
-         
+
+# Define file audits table
+# This table is meant to store the state of each file
+# when it was last audited (see 'audit_files.py')
+sa.Table('file_audits', metadata,
+         sa.Column('file_id', sa.Integer,
+                   sa.ForeignKey("files.file_id", name="fk_audit_file"),
+                   primary_key=True, autoincrement=False, nullable=False),
+         sa.Column('filesize', sa.Integer, nullable=True),
+         sa.Column('mtime', sa.Integer, nullable=True),
+         sa.Column('md5sum', sa.String(64), nullable=True),
+         sa.Column('status', sa.Enum(*AUDIT_STATUSES), nullable=False),
+         sa.Column('note', sa.String(NOTELEN), nullable=True),
+         sa.Column('last_audited', sa.DateTime, nullable=False,
+                   default=sa.func.now()),
+         mysql_engine='InnoDB', mysql_charset='ascii')
@@ -26,6 +26,10 @@ class SystemCallError(CoastGuardError):
     pass
 
 
+class SystemCallTimeout(SystemCallError):
+    pass
+
+
 class StandardProfileError(CoastGuardError):
     pass
 
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+
+"""
+Import the entries of the text observing log ('.prot') files
+into the observing log database's 'protinfo' table, so header
+correction can find them with an indexed database lookup.
+
+Files are parsed in parallel. Files whose modification time
+hasn't changed since they were last imported are skipped.
+"""
+
+import os
+import datetime
+import multiprocessing
+
+import sqlalchemy as sa
+
+import database
+import correct
+import utils
+import config
+
+# Number of (object, scan, obsutc) keys to look up per query
+KEY_CHUNK_SIZE = 300
+
+
+def get_prot_utc(info):
+    """Get the UTC start time of a parsed observing log entry.
+        The entry's date is the local (Berlin) date, but its
+        time is UTC.
+
+        Input:
+            info: An observing log entry (see 'correct.parse_obslog_line').
+
+        Output:
+            utc: The entry's start time, as a naive UTC datetime.
+    """
+    utcdt = datetime.datetime.combine(info['localdate'], datetime.time()) + \
+                datetime.timedelta(hours=info['utcstart'])
+    utcdt = correct.UTC_TZ.localize(utcdt)
+    if utcdt.astimezone(correct.BERLIN_TZ).date() != info['localdate']:
+        # Local date is a day ahead of the UTC date
+        utcdt -= datetime.timedelta(days=1)
+    return utcdt.replace(tzinfo=None)
+
+
+def parse_prot_file(args):
+    """Parse a text observing log file into rows for the
+        'protinfo' table.
+
+        Input:
+            args: A tuple (file name, name relative to the
+                observing log directory).
+
+        Outputs:
+            protfn: The name relative to the observing log directory.
+            mtime: The file's modification time.
+            rows: A list of dictionaries, one per entry.
+    """
+    fn, protfn = args
+    mtime = os.path.getmtime(fn)
+    rows = []
+    for line, info in correct.read_obslog_file(fn)['entries']:
+        rows.append({'object': info['name'],
+                     'prefname': utils.get_prefname(info['name']),
+                     'scan': info['scannum'],
+                     'localdate': info['localdate'],
+                     'obsutc': get_prot_utc(info),
+                     'utcstart': info['utcstart'],
+                     'lststart': info['lststart'],
+                     'azim': info['az'],
+                     'elev': info['alt'],
+                     'catalog_rastr': info['catalog_rastr'],
+                     'catalog_decstr': info['catalog_decstr'],
+                     'protfn': protfn})
+    return protfn, mtime, rows
+
+
+def get_imported(db):
+    """Get the modification times of the observing log files
+        as they were when last imported.
+
+        Input:
+            db: An obslog Database object.
+
+        Output:
+            imported: A dictionary mapping file names (relative to
+                the observing log directory) to modification times.
+    """
+    with db.transaction() as conn:
+        select = db.select([db.protfiles.c.protfn,
+                            db.protfiles.c.mtime])
+        result = conn.execute(select)
+        imported = dict([(row['protfn'], row['mtime'])
+                         for row in result.fetchall()])
+        result.close()
+    return imported
+
+
+def find_prot_files(obslogdir, imported, force=False):
+    """Find observing log files that need to be imported.
+
+        Inputs:
+            obslogdir: The directory to search (recursively).
+            imported: A dictionary of previously imported files
+                (see 'get_imported').
+            force: Import all files, even if they haven't changed.
+                (Default: False)
+
+        Output:
+            toimport: A list of (file name, name relative to
+                'obslogdir') tuples.
+    """
+    toimport = []
+    for dirpath, dirnames, filenames in os.walk(obslogdir):
+        for fn in filenames:
+            if not fn.endswith('.prot'):
+                continue
+            fn = os.path.join(dirpath, fn)
+            protfn = os.path.relpath(fn, obslogdir)
+            if force or (imported.get(protfn) != os.path.getmtime(fn)):
+                toimport.append((fn, protfn))
+    toimport.sort()
+    return toimport
+
+
+def load_batch(db, batch):
+    """Replace the entries of a batch of observing log files
+        in the database. Entries already imported from other
+        files are not duplicated.
+
+        Inputs:
+            db: An obslog Database object.
+            batch: A list of (protfn, mtime, rows) tuples
+                (see 'parse_prot_file').
+
+        Output:
+            ninserted: The number of entries inserted.
+    """
+    protfns = [protfn for protfn, mtime, rows in batch]
+    # Remove duplicates within the batch
+    torow = {}
+    for protfn, mtime, rows in batch:
+        for row in rows:
+            torow.setdefault((row['object'], row['scan'], row['obsutc']), row)
+    with db.transaction() as conn:
+        # Remove entries previously imported from these files
+        delete = db.protinfo.delete().\
+                    where(db.protinfo.c.protfn.in_(protfns))
+        conn.execute(delete)
+        # Skip entries already imported from other files. Only
+        # the batch's exact (object, scan, obsutc) keys are looked
+        # up, using the table's unique constraint.
+        keycols = sa.tuple_(db.protinfo.c.object,
+                            db.protinfo.c.scan,
+                            db.protinfo.c.obsutc)
+        keys = torow.keys()
+        for ii in xrange(0, len(keys), KEY_CHUNK_SIZE):
+            select = db.select([db.protinfo.c.object,
+                                db.protinfo.c.scan,
+                                db.protinfo.c.obsutc]).\
+                        where(keycols.in_(keys[ii:ii+KEY_CHUNK_SIZE]))
+            result = conn.execute(select)
+            for row in result:
+                torow.pop((row['object'], row['scan'], row['obsutc']), None)
+            result.close()
+        if torow:
+            conn.execute(db.protinfo.insert(), torow.values())
+        # Record the files as imported
+        delete = db.protfiles.delete().\
+                    where(db.protfiles.c.protfn.in_(protfns))
+        conn.execute(delete)
+        conn.execute(db.protfiles.insert(),
+                     [{'protfn': protfn,
+                       'mtime': mtime,
+                       'nentries': len(rows),
+                       'imported': datetime.datetime.now()}
+                      for protfn, mtime, rows in batch])
+    return len(torow)
+
+
+def main():
+    db = database.Database('obslog')
+    imported = get_imported(db)
+    toimport = find_prot_files(args.obslog_dir, imported, force=args.force)
+    utils.print_info("Found %d observing log files to import" %
+                     len(toimport), 1)
+
+    pool = multiprocessing.Pool(args.nprocs)
+    ninserted = 0
+    nfiles = 0
+    try:
+        batch = []
+        nrows = 0
+        for protfn, mtime, rows in pool.imap_unordered(parse_prot_file,
+                                                       toimport):
+            batch.append((protfn, mtime, rows))
+            nrows += len(rows)
+            if nrows >= args.batch_size:
+                ninserted += load_batch(db, batch)
+                nfiles += len(batch)
+                utils.print_info("Imported %d of %d files" %
+                                 (nfiles, len(toimport)), 2)
+                batch = []
+                nrows = 0
+        if batch:
+            ninserted += load_batch(db, batch)
+            nfiles += len(batch)
+    finally:
+        pool.close()
+        pool.join()
+    print "Imported %d entries from %d observing log files" % \
+            (ninserted, nfiles)
+
+
+if __name__ == '__main__':
+    parser = utils.DefaultArguments(description="Import text observing "
+                                                "logs into the observing "
+                                                "log database.")
+    parser.add_argument("--obslog-dir", dest='obslog_dir', type=str,
+                        default=config.obslog_dir,
+                        help="The directory containing observing log "
+                             "files. (Default: %s)" % config.obslog_dir)
+    parser.add_argument("-P", "--nprocs", dest='nprocs', type=int,
+                        default=4,
+                        help="The number of processes to use to parse "
+                             "files. (Default: 4)")
+    parser.add_argument("--batch-size", dest='batch_size', type=int,
+                        default=10000,
+                        help="The number of entries to load per database "
+                             "transaction. (Default: 10000)")
+    parser.add_argument("-f", "--force", dest='force', action='store_true',
+                        help="Import all files, even those that haven't "
+                             "changed since they were last imported. "
+                             "(Default: only import new or modified files)")
+    args = parser.parse_args()
+    main()
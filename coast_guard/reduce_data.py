@@ -2,15 +2,20 @@
 
 import multiprocessing
 import traceback
+import threading
+import Queue
 import warnings
 import tempfile
 import datetime
 import hashlib
 import shutil
+import socket
 import time
 import glob
 import sys
 import os
+import heapq
+import collections
 
 
 import toaster.config
@@ -31,14 +36,11 @@ from coast_guard import correct
 from coast_guard import calibrate
 
 import pyriseset as rs
+import sqlalchemy as sa
 
 # Set umask so that all group members can access files/directories created
 os.umask(0007)
 
-# A lock for each calibrator database file
-# The multiprocessing.Lock objects are created on demand
-CALDB_LOCKS = {}
-
 STAGE_TO_EXT = {'combined': '.cmb',
                 'grouped': '.list.txt',
                 'cleaned': '.clean',
@@ -46,6 +48,40 @@ STAGE_TO_EXT = {'combined': '.cmb',
 
 MINUTES_PER_DAY = 60.0*24.0
 
+# Approximate peak memory used by each action, as a multiple of
+# the size of its input data on disk. (Data are stored on disk
+# as 16-bit integers, but are loaded as 32-bit floats, and some
+# steps work on scrunched or cloned copies of the archive.)
+MEMORY_FACTORS = {'combine': 2.0,
+                  'correct': 2.0,
+                  'clean': 4.0,
+                  'reduce': 4.0,
+                  'calibrate': 4.0,
+                  'load': 1.0}
+
+# Approximate disk space written by each action, as a multiple
+# of the size of its input data on disk.
+DISK_FACTORS = {'combine': 1.0,
+                'correct': 1.0,
+                'clean': 1.0,
+                'reduce': 3.0,
+                'calibrate': 1.0,
+                'load': 0.0}
+
+# A cache of input data sizes, keyed by file ID
+INPUT_SIZES = {}
+
+# Archives kept in memory between the stages of a fused
+# reduction, keyed by the file ID of the archive
+FUSED_ARCHIVES = {}
+
+# The IDs of the files the task running in this process is
+# working on. Heartbeats are written for all of them.
+HEARTBEAT_FILE_IDS = []
+# The IDs of the directories being grouped by this process.
+# Heartbeats are written for all of them.
+HEARTBEAT_DIR_IDS = []
+
 SOURCELISTS = {'epta': ['J0030+0451', 'J0218+4232', 'J0613-0200', 
                         'J0621+1002', 'J0751+1807', 'J1012+5307', 
                         'J1022+1001', 'J1024-0719', 'J1600-3053', 
@@ -266,13 +302,16 @@ def load_directories(db, force=False, *args, **kwargs):
     return ninserts
 
 
-def load_groups(dirrow):
+def load_groups(dirrow, heartbeat_interval=60):
     """Given a row from the DB's directories table create a group 
         listing from the asterix data stored in the directories 
         and load it into the database.
 
         Inputs:
             dirrow: A row from the directories table.
+            heartbeat_interval: The number of seconds between
+                heartbeats written while the directory is
+                being grouped. (Default: 60 s)
 
         Outputs:
             ninserts: The number of group rows inserted.
@@ -285,19 +324,34 @@ def load_groups(dirrow):
     db = database.Database()
     path = dirrow['path']
     dir_id = dirrow['dir_id']
-    # Mark as running
+    # Mark as running. Only claim directories that are still 'new'
+    # in case another scheduler is grouping the same directory.
     with db.transaction() as conn:
         update = db.directories.update().\
-                    where(db.directories.c.dir_id == dir_id).\
+                    where((db.directories.c.dir_id == dir_id) &
+                          (db.directories.c.status == 'new')).\
                     values(status='running',
                             last_modified=datetime.datetime.now())
-        conn.execute(update)
+        result = conn.execute(update)
+        nclaimed = result.rowcount
+        result.close()
+    if nclaimed != 1:
+        utils.print_info("Dir ID %d was claimed by another "
+                         "scheduler" % dir_id, 2)
+        os.remove(tmplogfn)
+        return 0
     if dirrow['status'] != 'new':
         return errors.BadStatusError("Groupings can only be "
                                      "generated for 'directory' entries "
                                      "with status 'new'. (The status of "
                                      "Dir ID %d is '%s'.)" %
                                      (dir_id, dirrow['status']))
+    HEARTBEAT_DIR_IDS[:] = [dir_id]
+    stop = threading.Event()
+    beater = threading.Thread(target=send_heartbeats,
+                              args=(heartbeat_interval, stop))
+    beater.daemon = True
+    beater.start()
     try:
         ninserts = 0
         values = []
@@ -410,17 +464,23 @@ def load_groups(dirrow):
             conn.execute(update)
         ninserts += len(values)
     finally:
+        stop.set()
+        beater.join()
+        HEARTBEAT_DIR_IDS[:] = []
         if os.path.isfile(tmplogfn):
             os.remove(tmplogfn)
     return ninserts
 
 
-def load_combined_file(filerow):
+def load_combined_file(filerow, keep_in_memory=False):
     """Given a row from the DB's files table create a combined
         archive and load it into the database.
 
         Input:
             filerow: A row from the files table.
+            keep_in_memory: Keep the combined archive in memory
+                so the next stage of a fused reduction can use it
+                without re-reading the file. (Default: False)
 
         Outputs:
             file_id: The ID of newly loaded 'combined' file.
@@ -475,19 +535,15 @@ def load_combined_file(filerow):
             utils.print_info("Reducing %s from %d to %g channels" %
                              (cmbfn, arf['nchan'], new_nchan), 2)
             # Scrunch channels
-            utils.execute(['pam', '-m', '--setnchn', "%d" % new_nchan, cmbfn])
-            # Re-load archive file
-            arf = utils.ArchiveFile(cmbfn)
+            arf = utils.edit_archive(arf, nchan=new_nchan)
         else:
             note = None
-
-        # Make diagnostic plots
-        fullresfn, lowresfn = make_summary_plots(arf)
+        # Checksum the file while it is still in the page cache
+        md5 = utils.BackgroundMD5Sum(cmbfn)
 
         values = {'filepath': cmbdir,
                   'filename': os.path.basename(cmbfn),
                   'stage': 'combined',
-                  'md5sum': utils.get_md5sum(cmbfn),
                   'filesize': os.path.getsize(cmbfn),
                   'parent_file_id': parent_file_id,
                   'note': note,
@@ -498,11 +554,17 @@ def load_combined_file(filerow):
             values['ephem_md5sum'] = hashlib.md5(ephem).hexdigest()
         except errors.InputError, exc:
             warnings.warn(exc.get_message(), errors.CoastGuardWarning)
+        # Make diagnostic plots
+        fullresfn, lowresfn = make_summary_plots(arf)
         diagvals = [{'diagnosticpath': os.path.dirname(fullresfn),
                      'diagnosticname': os.path.basename(fullresfn)},
                     {'diagnosticpath': os.path.dirname(lowresfn),
                      'diagnosticname': os.path.basename(lowresfn)}
                    ]
+        values['md5sum'] = md5.get()
+        if keep_in_memory:
+            # Load the archive while it is still in the page cache
+            arf.get_archive()
     except Exception as exc:
         utils.print_info("Exception caught while working on File ID %d" %
                          parent_file_id, 0)
@@ -549,10 +611,12 @@ def load_combined_file(filerow):
                                current_file_id=new_file_id,
                                last_modified=datetime.datetime.now())
             conn.execute(update)
+        if keep_in_memory:
+            FUSED_ARCHIVES[new_file_id] = arf
     return new_file_id
 
 
-def load_corrected_file(filerow):
+def load_corrected_file(filerow, keep_in_memory=False):
     """Given a row from the DB's files table referring to a
         status='new', stage='combined' file, process the file
         by correcting its header and load the new file into
@@ -560,6 +624,9 @@ def load_corrected_file(filerow):
 
         Inputs:
             filerow: A row from the files table.
+            keep_in_memory: Keep the corrected archive in memory
+                so the next stage of a fused reduction can use it
+                without re-reading the file. (Default: False)
 
         Output:
             file_id: The ID of the newly loaded 'corrected' file.
@@ -589,27 +656,18 @@ def load_corrected_file(filerow):
     infn = os.path.join(filerow['filepath'], filerow['filename'])
     try:
         global mjd_to_receiver
-        if (filerow['obsband'] == 'Lband') and (mjd_to_receiver is not None):
-            imjd = int(filerow['start_mjd'])
-            rcvr = mjd_to_receiver.get(imjd, 'X')
-            if rcvr == '?':
-                raise errors.HeaderCorrectionError("Using MJD to receiver mapping "
-                                                   "but receiver is unknown (%s)" % rcvr)
-            elif rcvr == 'X':
-                raise errors.HeaderCorrectionError("Using MJD to receiver mapping "
-                                                   "but MJD (%d) has no entry" % imjd)
-            elif rcvr == '1':
-                # Single pixel receiver
-                rcvr = "P200-3"
-            elif rcvr == '7':
-                # 7-beam receiver
-                rcvr = "P217-3"
-            else:
-                raise errors.HeaderCorrectionError("Using MJD to receiver mapping "
-                                                   "but receiver is invalid (%s)" % rcvr)
-        else:
-            rcvr = None # Receiver will be determined automatically
-        corrfn, corrstr, note = correct.correct_header(infn, receiver=rcvr)
+        # The header is corrected in memory. Keep the corrected
+        # archive so it doesn't need to be loaded again. Use the
+        # archive kept in memory by the previous stage, if any.
+        inarf = FUSED_ARCHIVES.pop(parent_file_id, None)
+        if inarf is None:
+            inarf = utils.ArchiveFile(infn)
+        # L-band receivers are looked up in the MJD to receiver
+        # mapping, if there is one. Otherwise the receiver is
+        # determined automatically.
+        corrfn, corrstr, note = correct.correct_header(inarf,
+                                        mjd_to_receiver=mjd_to_receiver)
+        ar = inarf.get_archive()
 
         arf = utils.ArchiveFile(corrfn)
 
@@ -623,22 +681,31 @@ def load_corrected_file(filerow):
         except OSError:
             # Directory already exists
             pass
-        shutil.move(corrfn, os.path.join(archivedir, archivefn))
+        utils.move_file(corrfn, os.path.join(archivedir, archivefn))
         # Update 'corrfn' so it still refers to the file
         corrfn = os.path.join(archivedir, archivefn)
         arf.fn = corrfn
+        # Checksum the file while it is still in the page cache
+        md5 = utils.BackgroundMD5Sum(corrfn)
 
         # Make diagnostic plots
         fullresfn, lowresfn = make_summary_plots(arf)
+        diagvals = [{'diagnosticpath': os.path.dirname(fullresfn),
+                     'diagnosticname': os.path.basename(fullresfn)},
+                    {'diagnosticpath': os.path.dirname(lowresfn),
+                     'diagnosticname': os.path.basename(lowresfn)}
+                   ]
 
         # Pre-compute values to insert because some might be
         # slow to generate
+        # Keep the corrected archive that is already in memory
         arf = utils.ArchiveFile(corrfn)
+        arf.ar = ar
         values = {'filepath': archivedir,
                   'filename': archivefn,
                   'stage': 'corrected',
                   'note': note,
-                  'md5sum': utils.get_md5sum(corrfn),
+                  'md5sum': md5.get(),
                   'filesize': os.path.getsize(corrfn),
                   'parent_file_id': parent_file_id,
                   'coords': arf['coords'],
@@ -648,11 +715,6 @@ def load_corrected_file(filerow):
             values['ephem_md5sum'] = hashlib.md5(ephem).hexdigest()
         except errors.InputError, exc:
             warnings.warn(exc.get_message(), errors.CoastGuardWarning)
-        diagvals = [{'diagnosticpath': os.path.dirname(fullresfn),
-                     'diagnosticname': os.path.basename(fullresfn)},
-                    {'diagnosticpath': os.path.dirname(lowresfn),
-                     'diagnosticname': os.path.basename(lowresfn)}
-                   ]
     except Exception as exc:
         utils.print_info("Exception caught while working on File ID %d" %
                          parent_file_id, 0)
@@ -708,6 +770,8 @@ def load_corrected_file(filerow):
                     (config.outfn_template+ext) % arf)
         move_log(db, log_id, archivedir,
                     (config.outfn_template+".log") % arf)
+        if keep_in_memory:
+            FUSED_ARCHIVES[file_id] = arf
     return file_id
 
 
@@ -744,8 +808,11 @@ def load_cleaned_file(filerow):
                         "(For File ID %d: status='%s', stage='%s'.)" %
                         (parent_file_id, filerow['status'], filerow['stage']))
     infn = os.path.join(filerow['filepath'], filerow['filename'])
+    # Use the archive kept in memory by the previous stage, if any
+    arf = FUSED_ARCHIVES.pop(parent_file_id, None)
     try:
-        arf = utils.ArchiveFile(infn)
+        if arf is None:
+            arf = utils.ArchiveFile(infn)
         # Clean the data file
         config.cfg.load_configs_for_archive(arf)
         cleaner_queue = [cleaners.load_cleaner('rcvrstd'),
@@ -768,6 +835,8 @@ def load_cleaned_file(filerow):
             # Directory already exists:
             pass
         arf.get_archive().unload(cleanfn)
+        # Checksum the file while it is still in the page cache
+        md5 = utils.BackgroundMD5Sum(cleanfn)
         arf = utils.ArchiveFile(cleanfn)
 
         # Make diagnostic plots
@@ -778,7 +847,7 @@ def load_cleaned_file(filerow):
         values = {'filepath': archivedir,
                   'filename': archivefn,
                   'stage': 'cleaned',
-                  'md5sum': utils.get_md5sum(cleanfn),
+                  'md5sum': md5.get(),
                   'filesize': os.path.getsize(cleanfn),
                   'parent_file_id': parent_file_id,
                   'coords': arf['coords'],
@@ -841,7 +910,51 @@ def load_cleaned_file(filerow):
     return file_id
 
 
-def load_calibrated_file(filerow, lock):
+def load_reduced_file(filerow, keep_intermediates=False):
+    """Given a row from the DB's files table referring to a
+        status='new', stage='grouped' file, combine, correct and
+        clean the observation in a single task. The archive is
+        kept in memory between stages rather than being re-read
+        from disk.
+
+        Each stage writes its file and is loaded into the database,
+        with its diagnostic plots, and logged, just as if it were run
+        as a separate task. Only re-reading the files is skipped.
+        Unless intermediate files are kept, the combined and corrected
+        files are deleted once the cleaned file is loaded.
+
+        Inputs:
+            filerow: A row from the files table.
+            keep_intermediates: Keep the combined and corrected files.
+                (Default: False)
+
+        Ouput:
+            file_id: The ID of the newly loaded 'cleaned' file,
+                or None if another scheduler claimed one of the
+                intermediate files first.
+    """
+    db = database.Database()
+
+    cmb_file_id = load_combined_file(filerow, keep_in_memory=True)
+    cmbrow = claim_next_stage(db, cmb_file_id)
+    if cmbrow is None:
+        FUSED_ARCHIVES.pop(cmb_file_id, None)
+        return None
+
+    corr_file_id = load_corrected_file(cmbrow, keep_in_memory=True)
+    corrrow = claim_next_stage(db, corr_file_id)
+    if corrrow is None:
+        FUSED_ARCHIVES.pop(corr_file_id, None)
+        return None
+
+    file_id = load_cleaned_file(corrrow)
+    if not keep_intermediates:
+        delete_file(db, cmb_file_id)
+        delete_file(db, corr_file_id)
+    return file_id
+
+
+def load_calibrated_file(filerow):
     """Given a row from the DB's files table referring to a
         status='new' file, process the file
         by calibrating it and load the new file into the database.
@@ -854,7 +967,6 @@ def load_calibrated_file(filerow, lock):
 
         Inputs:
             filerow: A row from the files table.
-            lock: Lock for calibrator database file
 
         Ouput:
             file_id: The ID of the newly loaded 'calibrated' file.
@@ -917,10 +1029,11 @@ def load_calibrated_file(filerow, lock):
             # Calibrator scan
             # Prepare the data file for being used to calibrate pulsar scans
 
-            utils.execute(['pam', '--setnchn', '%d' % nchans, '-T',
-                           '-e', 'pcal.T', infn])
             outpath = os.path.splitext(infn)[0]+'.pcal.T'
-            arf = utils.ArchiveFile(outpath)
+            arf = utils.edit_archive(arf, nchan=nchans, tscrunch=True,
+                                     outfn=outpath)
+            # Checksum the file while it is still in the page cache
+            md5 = utils.BackgroundMD5Sum(outpath)
             plotfn = make_stokes_plot(arf)
             diagvals = [{'diagnosticpath': os.path.dirname(plotfn),
                          'diagnosticname': os.path.basename(plotfn)}]
@@ -934,11 +1047,9 @@ def load_calibrated_file(filerow, lock):
             caldbpath = os.path.join(caldbrow['caldbpath'],
                                         caldbrow['caldbname'])
             utils.print_debug("Calibration DB: %s" % caldbpath, 'calibrate')
-            try:
-                lock.acquire()
-                calfn = calibrate.calibrate(infn, caldbpath, nchans=nchans)
-            finally:
-                lock.release()
+            calrow = calibrate.get_closest_calibrator(db, obs_id)
+            calfn = calibrate.calibrate(infn, caldbpath, nchans=nchans,
+                                        calrow=calrow)
 
             if calfn is not None:
                 calpath, calname = os.path.split(calfn)
@@ -961,6 +1072,8 @@ def load_calibrated_file(filerow, lock):
                                                 calname))
 
             outpath = os.path.splitext(infn)[0]+'.calibP'
+            # Checksum the file while it is still in the page cache
+            md5 = utils.BackgroundMD5Sum(outpath)
             # Make diagnostic plots
             arf = utils.ArchiveFile(outpath)
             fullresfn, lowresfn = make_summary_plots(arf)
@@ -980,7 +1093,7 @@ def load_calibrated_file(filerow, lock):
 
         # Add other file-related values to insert into the DB
         values['filepath'], values['filename'] = os.path.split(outpath)
-        values['md5sum'] = utils.get_md5sum(outpath)
+        values['md5sum'] = md5.get()
         values['filesize'] = os.path.getsize(outpath)
         values['coords'] = arf['coords']
         try:
@@ -1046,17 +1159,16 @@ def load_calibrated_file(filerow, lock):
             conn.execute(update)
         if filerow['obstype'] == 'cal':
             # Update the calibrator database
-            try:
-                lock.acquire()
-                calibrate.update_caldb(db, arf['name'], force=True)
-                reattempt_calibration(db, name)
-            finally:
-                lock.release()
+            calibrate.update_caldb(db, arf['name'])
+            reattempt_calibration(db, name)
     return file_id
 
 
 def reattempt_calibration(db, sourcename):
     """Mark files that have failed calibration to be reattempted.
+        Only files of observations for which there is a potential
+        calibrator scan are marked. All files are updated with a
+        single statement.
 
         Inputs:
             db: A Database object.
@@ -1070,34 +1182,32 @@ def reattempt_calibration(db, sourcename):
     if name.endswith('_R'):
         name = name[:-2]
 
-    db = database.Database()
+    psrobs = db.obs.alias('psrobs')
+    calobs = db.obs.alias('calobs')
+    polcal_match = calibrate.get_polcal_match(psrobs, calobs)
+    # Observations of the source that have a potential calibrator scan
+    # (NOTE: The 'files' table can't be used in the sub-query because
+    #     MySQL doesn't allow selecting from the table being updated.)
+    calibratable = db.select([psrobs.c.obs_id],
+                    from_obj=[psrobs.\
+                        join(calobs,
+                            onclause=polcal_match)]).\
+                    where(psrobs.c.sourcename == name)
     with db.transaction() as conn:
-        # Get rows that need to be updated
-        # The update is a two-part process because
-        # a join is required. (Can updates include joins?)
-        select = db.select([db.files],
-                    from_obj=[db.files.\
-                        outerjoin(db.obs,
-                            onclause=db.files.c.obs_id ==
-                                    db.obs.c.obs_id)]).\
+        update = db.files.update().\
                     where((db.files.c.status == 'calfail') &
                             (db.files.c.stage == 'cleaned') &
                             (db.files.c.qcpassed == True) &
-                            (db.obs.c.sourcename == name))
-        result = conn.execute(select)
-        rows = result.fetchall()
-        result.close()
-        # Now update rows
-        for row in rows:
-            update = db.files.update().\
-                    where(db.files.c.file_id == row['file_id']).\
+                            (db.files.c.obs_id.in_(calibratable))).\
                     values(status='new',
                             note='Reattempting calibration',
                             last_modified=datetime.datetime.now())
-            conn.execute(update)
-        utils.print_info("Resetting status to 'new' (from 'calfail') "
-                         "for %d files with sourcename='%s'" %
-                         (len(rows), name), 2)
+        result = conn.execute(update)
+        nreset = result.rowcount
+        result.close()
+    utils.print_info("Resetting status to 'new' (from 'calfail') "
+                     "for %d files with sourcename='%s'" %
+                     (nreset, name), 2)
 
 
 def load_to_toaster(filerow):
@@ -1158,9 +1268,9 @@ def can_calibrate(db, obs_id):
     return bool(get_potential_polcal_scans(db, obs_id))
 
 
-def get_potential_polcal_scans(db, obs_id):
-    """Return list of potential polarization calibration scans
-        for the given observation.
+def get_all_potential_polcal_scans(db, obs_ids):
+    """Return lists of potential polarization calibration scans
+        for many observations using a single query.
 
         NOTE: Scans that have not completed processing or 
             quality control are still considered to be 
@@ -1168,56 +1278,85 @@ def get_potential_polcal_scans(db, obs_id):
 
         Inputs:
             db: A database object.
-            obs_id: The ID number of an entry in the database.
+            obs_ids: A list of ID numbers of 'pulsar' observations.
 
         Outputs:
-            cals: List of potential calibrator scans.
+            cals: A dictionary mapping each observation ID to
+                its list of potential calibrator scans.
     """
-    obsrow = get_obs(db, obs_id)
-    if obsrow['obstype'] != 'pulsar':
-        raise errors.InputError("Only observations of type 'pulsar' "
-                                "can be calibrated. Obstype for obs_id %d: %s" %
-                                (obs_id, obsrow['obstype']))
-    psrchive_cfg = utils.get_psrchive_configs()
-    polcal_validity_minutes = float(psrchive_cfg.get("Database::short_time_scale", 120))
-    mjdrange = (obsrow['start_mjd']-polcal_validity_minutes/MINUTES_PER_DAY,
-                obsrow['start_mjd']+polcal_validity_minutes/MINUTES_PER_DAY)
-    # Now try to find a compatible calibrator scan
+    cals = {}
+    if not obs_ids:
+        return cals
+    psrobs = db.obs.alias('psrobs')
+    calobs = db.obs.alias('calobs')
+    polcal_match = calibrate.get_polcal_match(psrobs, calobs)
     with db.transaction() as conn:
-        select = db.select([db.files],
-                    from_obj=[db.files.\
-                        outerjoin(db.obs,
-                            onclause=(db.files.c.obs_id ==
-                                        db.obs.c.obs_id))]).\
-                    where((db.obs.c.obstype == 'cal') &
-                            (db.obs.c.sourcename == ("%s_R" %
-                                    obsrow['sourcename'])) &
-                            ((db.obs.c.rcvr == obsrow['rcvr']) |
-                                (db.obs.c.rcvr.is_(None))) &
-                            db.obs.c.start_mjd.between(*mjdrange) &
-                            (db.obs.c.bw == obsrow['bw']) &
-                            (db.obs.c.freq == obsrow['freq'])).\
+        select = db.select([db.files,
+                            psrobs.c.obs_id.label('psr_obs_id'),
+                            psrobs.c.obstype.label('psr_obstype'),
+                            psrobs.c.start_mjd.label('psr_start_mjd')],
+                    from_obj=[psrobs.\
+                        outerjoin(calobs.\
+                            join(db.files,
+                                onclause=(db.files.c.obs_id ==
+                                            calobs.c.obs_id)),
+                            onclause=polcal_match)]).\
+                    where(psrobs.c.obs_id.in_(obs_ids)).\
                     order_by(db.files.c.added.asc())
         results = conn.execute(select)
         rows = results.fetchall()
         results.close()
-    # Only keep most recently added file for each
-    # observation. Rows are sorted in the query above.
-    obs_ids = []
-    for ii in reversed(range(len(rows))):
-        if rows[ii]['obs_id'] in obs_ids:
-            rows.pop(ii)
-        else:
-            obs_ids.append(rows[ii]['obs_id'])
-    # Throw away observations that failed processing or quality control
-    rows = [row for row in rows if (row['status'] != "failed") and 
-                                   (row['qcpassed'] != False)]
     mjdnow = rs.utils.mjdnow()
-    if not rows and ((mjdnow - obsrow['start_mjd']) < 7):
-        # Observation is less than 1 week old.
-        # Let's hold out hope that it can be calibrated.
-        return ["Obs is less than 7 days old... maybe data still need to be copied"]
-    return rows
+    byobs = {}
+    for row in rows:
+        if row['psr_obstype'] != 'pulsar':
+            raise errors.InputError("Only observations of type 'pulsar' "
+                                    "can be calibrated. Obstype for "
+                                    "obs_id %d: %s" %
+                                    (row['psr_obs_id'], row['psr_obstype']))
+        calrows, start_mjd = byobs.setdefault(row['psr_obs_id'],
+                                              ([], row['psr_start_mjd']))
+        if row['file_id'] is not None:
+            calrows.append(row)
+    for obs_id, (calrows, start_mjd) in byobs.iteritems():
+        # Only keep most recently added file for each
+        # observation. Rows are sorted in the query above.
+        cal_obs_ids = []
+        for ii in reversed(range(len(calrows))):
+            if calrows[ii]['obs_id'] in cal_obs_ids:
+                calrows.pop(ii)
+            else:
+                cal_obs_ids.append(calrows[ii]['obs_id'])
+        # Throw away observations that failed processing or quality control
+        calrows = [row for row in calrows if (row['status'] != "failed") and 
+                                             (row['qcpassed'] != False)]
+        if not calrows and ((mjdnow - start_mjd) < 7):
+            # Observation is less than 1 week old.
+            # Let's hold out hope that it can be calibrated.
+            calrows = ["Obs is less than 7 days old... maybe data still need to be copied"]
+        cals[obs_id] = calrows
+    return cals
+
+
+def get_potential_polcal_scans(db, obs_id):
+    """Return list of potential polarization calibration scans
+        for the given observation.
+
+        NOTE: Scans that have not completed processing or 
+            quality control are still considered to be 
+            potential calibration scans.
+
+        Inputs:
+            db: A database object.
+            obs_id: The ID number of an entry in the database.
+
+        Outputs:
+            cals: List of potential calibrator scans.
+    """
+    cals = get_all_potential_polcal_scans(db, [obs_id])
+    if obs_id not in cals:
+        raise errors.DatabaseError("No obs row with obs_id=%d!" % obs_id)
+    return cals[obs_id]
 
 
 def get_parent(file_id, db=None):
@@ -1433,7 +1572,6 @@ def move_log(db, log_id, destdir, destfn=None):
         except OSError:
             # Directory already exists
             pass
-        shutil.copy(src, dest)
         # Update database
         update = db.logs.update().\
                     where(db.logs.c.log_id == log_id).\
@@ -1441,8 +1579,8 @@ def move_log(db, log_id, destdir, destfn=None):
                             logname=destfn,
                             last_modified=datetime.datetime.now())
         conn.execute(update)
-        # Remove original
-        os.remove(src)
+        # Move file. If this fails the database update is rolled back.
+        utils.move_file(src, dest)
         utils.print_info("Moved log from %s to %s. The database "
                          "has been updated accordingly." % (src, dest))
 
@@ -1521,7 +1659,6 @@ def move_file(db, file_id, destdir, destfn=None):
             except OSError:
                 # Directory already exists
                 pass
-            shutil.copy(src, dest)
             # Update database
             update = db.files.update().\
                         where(db.files.c.file_id == file_id).\
@@ -1529,8 +1666,10 @@ def move_file(db, file_id, destdir, destfn=None):
                                 filename=destfn,
                                 last_modified=datetime.datetime.now())
             conn.execute(update)
-            # Remove original
-            os.remove(src)
+            # Move file. If this fails the database update is rolled back.
+            # Files copied between devices are checked against their
+            # recorded MD5 sum as they are copied.
+            utils.move_file(src, dest, md5sum=ff['md5sum'])
             utils.print_info("Moved archive file from %s to %s. The database "
                              "has been updated accordingly." % (src, dest), 2)
 
@@ -1767,6 +1906,7 @@ def get_toload(db):
                             db.obs.c.dir_id,
                             db.obs.c.sourcename,
                             db.obs.c.obstype,
+                            db.obs.c.backend,
                             db.obs.c.start_mjd],
                     from_obj=[db.obs.\
                         outerjoin(db.files,
@@ -1802,7 +1942,7 @@ def get_todo(db, action, priorities=None):
                                             "are '%s'." %
                                             "', '".join(ACTIONS.keys()))
 
-    target_stages, qcpassed_only, withlock, actfunc = ACTIONS[action]
+    target_stages, qcpassed_only, actfunc = ACTIONS[action]
     whereclause = db.files.c.status == 'new'
     if target_stages is not None:
         whereclause &= db.files.c.stage.in_(target_stages)
@@ -1822,7 +1962,9 @@ def get_todo(db, action, priorities=None):
                             db.obs.c.obsband,
                             db.obs.c.rcvr,
                             db.obs.c.backend,
-                            db.obs.c.start_mjd],
+                            db.obs.c.start_mjd,
+                            db.obs.c.nsubints,
+                            db.obs.c.nsubbands],
                     from_obj=[db.obs.\
                         outerjoin(db.files,
                             onclause=db.files.c.file_id ==
@@ -1838,16 +1980,391 @@ def get_todo(db, action, priorities=None):
     return rows
 
 
-def launch_task(db, action, row):
-    """Launch a single task acting on the relevant file.
+def get_task_row(db, file_id):
+    """Get a file's row, with the same columns as the rows
+        returned by 'get_todo'.
+
+        Inputs:
+            db: A Database object to use.
+            file_id: The ID of the file.
+
+        Output:
+            row: The file's row.
+    """
+    with db.transaction() as conn:
+        select = db.select([db.files,
+                            db.obs.c.dir_id,
+                            db.obs.c.sourcename,
+                            db.obs.c.obstype,
+                            db.obs.c.obsband,
+                            db.obs.c.rcvr,
+                            db.obs.c.backend,
+                            db.obs.c.start_mjd,
+                            db.obs.c.nsubints,
+                            db.obs.c.nsubbands],
+                    from_obj=[db.obs.\
+                        outerjoin(db.files,
+                            onclause=db.files.c.obs_id ==
+                                    db.obs.c.obs_id)]).\
+                            where(db.files.c.file_id == file_id)
+        result = conn.execute(select)
+        rows = result.fetchall()
+        result.close()
+    if len(rows) != 1:
+        raise errors.DatabaseError("Bad number of files (%d) with ID=%d!" %
+                                   (len(rows), file_id))
+    return rows[0]
+
+
+def send_heartbeats(interval, stop):
+    """Periodically record in the database that the task running
+        in this process is still alive, until 'stop' is set.
+        Heartbeats are written for all files in HEARTBEAT_FILE_IDS
+        and all directories in HEARTBEAT_DIR_IDS.
+
+        Inputs:
+            interval: The number of seconds between heartbeats.
+            stop: A threading.Event that is set when the task is done.
+
+        Outputs:
+            None
+    """
+    db = database.Database()
+    while True:
+        try:
+            file_ids = list(HEARTBEAT_FILE_IDS)
+            dir_ids = list(HEARTBEAT_DIR_IDS)
+            with db.transaction() as conn:
+                if file_ids:
+                    update = db.files.update().\
+                                where(db.files.c.file_id.in_(file_ids) &
+                                      db.files.c.status.in_(['submitted',
+                                                             'running'])).\
+                                values(heartbeat=datetime.datetime.now())
+                    conn.execute(update)
+                if dir_ids:
+                    update = db.directories.update().\
+                                where(db.directories.c.dir_id.in_(dir_ids) &
+                                      (db.directories.c.status == 'running')).\
+                                values(heartbeat=datetime.datetime.now())
+                    conn.execute(update)
+        except Exception as exc:
+            warnings.warn("Could not write heartbeat for File IDs %s "
+                          "and Dir IDs %s: %s" %
+                          (file_ids, dir_ids, str(exc)),
+                          errors.CoastGuardWarning)
+        if stop.wait(interval):
+            break
+
+
+def get_input_size(row):
+    """Return the size of a task's input data. The size is
+        proportional to nsub x nchan x nbin x npol.
+
+        Input:
+            row: A single row representing the task.
+
+        Output:
+            nbytes: The size of the input data, in bytes.
+    """
+    file_id = row['file_id']
+    if file_id not in INPUT_SIZES:
+        insize = row['filesize']
+        if row['stage'] == 'grouped':
+            # The file is a listing of sub-ints. Assume all sub-ints
+            # are the same size as the first one.
+            try:
+                subdirs, subints = combine.read_listing(
+                            os.path.join(row['filepath'], row['filename']))
+                insize = os.path.getsize(os.path.join(subdirs[0], subints[0])) * \
+                            (row['nsubbands'] or len(subdirs)) * \
+                            (row['nsubints'] or len(subints))
+            except (IOError, OSError, IndexError):
+                pass
+        INPUT_SIZES[file_id] = insize
+    return INPUT_SIZES[file_id]
+
+
+def estimate_memory(action, row):
+    """Estimate the peak memory required to perform an action
+        on a file.
+
+        Inputs:
+            action: The action to perform.
+            row: A single row representing the task.
+
+        Output:
+            nbytes: The estimated number of bytes of memory required.
+    """
+    return MEMORY_FACTORS.get(action, 1.0)*get_input_size(row)
+
+
+def estimate_disk_usage(action, row):
+    """Estimate the disk space that will be written when
+        performing an action on a file.
+
+        Inputs:
+            action: The action to perform.
+            row: A single row representing the task.
+
+        Output:
+            needs: A dictionary mapping directories to the
+                estimated number of bytes written below them.
+    """
+    nbytes = DISK_FACTORS.get(action, 1.0)*get_input_size(row)
+    needs = {}
+    if nbytes:
+        needs[config.output_location] = nbytes
+        if action in ('combine', 'reduce'):
+            # Sub-ints are prepared in a temporary directory
+            # before being combined
+            needs[config.tmp_directory] = \
+                    needs.get(config.tmp_directory, 0) + get_input_size(row)
+    return needs
+
+
+def check_disk_space(needs, reserved, min_free):
+    """Check if there is enough free disk space for a task.
+
+        Inputs:
+            needs: A dictionary mapping directories to the
+                number of bytes the task will write below them.
+            reserved: A list of similar dictionaries for
+                tasks that are in progress.
+            min_free: The number of bytes to always keep free.
+
+        Outputs:
+            ok: True if there is enough space.
+            msg: A description of the first filesystem without
+                enough space, or None.
+    """
+    # Space reserved by tasks in progress, per device
+    reserved_by_dev = {}
+    for taskneeds in reserved:
+        for path, nbytes in taskneeds.iteritems():
+            dev = os.stat(path).st_dev
+            reserved_by_dev[dev] = reserved_by_dev.get(dev, 0) + nbytes
+    needed_by_dev = {}
+    for path, nbytes in needs.iteritems():
+        dev = os.stat(path).st_dev
+        needed_by_dev[dev] = needed_by_dev.get(dev, 0) + nbytes
+    for path in needs:
+        dev = os.stat(path).st_dev
+        stats = os.statvfs(path)
+        free = stats.f_bavail*stats.f_frsize - reserved_by_dev.get(dev, 0)
+        if free - needed_by_dev[dev] < min_free:
+            return False, ("%.1f GB free for %s (%.1f GB needed, "
+                           "%.1f GB to be kept free)" %
+                           (free/1024.0**3, path,
+                            needed_by_dev[dev]/1024.0**3,
+                            min_free/1024.0**3))
+    return True, None
+
+
+def get_share_key(row):
+    """Return the key used to share processing fairly between
+        pulsars and backends. Calibrator scans share with the
+        pulsar they are used to calibrate.
+
+        Input:
+            row: A single row representing a task.
+
+        Output:
+            key: A (sourcename, backend) tuple.
+    """
+    name = row['sourcename']
+    if name.endswith('_R'):
+        name = name[:-2]
+    return (name, row['backend'])
+
+
+def schedule_tasks(candidates, inprogress, recent_mjd):
+    """Order candidate tasks according to the scheduling policy:
+        1) Observations that started after 'recent_mjd' go first.
+        2) Actions on observations further down the reduction chain
+            go before actions on observations that are less advanced,
+            so observations that are in progress are finished before
+            new ones are started.
+        3) Tasks with the same urgency and stage are shared fairly
+            between pulsars/backends. The pulsar/backend with the
+            fewest tasks in progress (or already scheduled) goes next.
+        The order in which rows for a single pulsar/backend are
+        provided is preserved.
+
+        Tasks are ordered lazily, so only as many tasks as are
+        taken from the returned generator are ordered.
+
+        Inputs:
+            candidates: A list of (action, row) tuples.
+            inprogress: A dictionary describing tasks in progress.
+                (See 'main')
+            recent_mjd: Observations that started after this MJD
+                are considered urgent.
+
+        Output:
+            ordered: A generator of (action, row) tuples, in the order
+                they should be launched.
+    """
+    # Number of tasks in progress for each pulsar/backend
+    counts = {}
+    for task in inprogress.values():
+        counts[task['share']] = counts.get(task['share'], 0) + 1
+
+    # Group the candidates by urgency and stage, then by pulsar/backend
+    buckets = {}
+    for action, row in candidates:
+        urgent = (row['start_mjd'] is not None) and \
+                    (row['start_mjd'] > recent_mjd)
+        priority = (not urgent, STAGE_ORDER.index(action))
+        shares = buckets.setdefault(priority, collections.OrderedDict())
+        if get_share_key(row) not in shares:
+            shares[get_share_key(row)] = collections.deque()
+        shares[get_share_key(row)].append((action, row))
+
+    for priority in sorted(buckets.keys()):
+        shares = buckets[priority]
+        # Heap of (number of tasks, order of first appearance, key)
+        # so the pulsar/backend with the fewest tasks comes first
+        heap = [(counts.get(key, 0), ii, key)
+                for ii, key in enumerate(shares.keys())]
+        heapq.heapify(heap)
+        while heap:
+            count, ii, key = heapq.heappop(heap)
+            yield shares[key].popleft()
+            counts[key] = count + 1
+            if shares[key]:
+                heapq.heappush(heap, (count + 1, ii, key))
+
+
+def get_memory_budget():
+    """Return the default memory budget for running tasks:
+        80% of the physical memory.
+
+        Inputs:
+            None
+
+        Output:
+            nbytes: The memory budget, in bytes.
+    """
+    physmem = os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')
+    return 0.8*physmem
+
+
+def worker(taskq, doneq, maxtasks=None, heartbeat_interval=60,
+           action_kwargs={}):
+    """Run tasks received from the scheduler until told to stop,
+        or until 'maxtasks' tasks have been run. Per-process caches
+        (e.g. version IDs, pulsar names, configurations) are kept
+        warm between tasks.
+
+        Each task is a tuple: (task name, action, file row).
+        The worker reports to the scheduler by putting tuples
+        into 'doneq':
+            ('started', worker name, task name, None) when a task starts.
+            ('finished', worker name, task name, errmsg) when a task
+                is done. 'errmsg' is None if the task succeeded.
+            ('retired', worker name, None, None) when the worker exits.
+
+        Inputs:
+            taskq: A multiprocessing.Queue to get tasks from.
+                A value of None tells the worker to exit.
+            doneq: A multiprocessing.Queue to report to.
+            maxtasks: The number of tasks to run before exiting.
+                (Default: no limit)
+            heartbeat_interval: The number of seconds between
+                heartbeats written to the database while a task
+                is running. (Default: 60 s)
+            action_kwargs: A dictionary of additional keyword arguments
+                to pass to each action's function, keyed by action.
+                (Default: no additional arguments)
+
+        Outputs:
+            None
+    """
+    me = multiprocessing.current_process().name
+    ntasks = 0
+    try:
+        while (maxtasks is None) or (ntasks < maxtasks):
+            task = taskq.get()
+            if task is None:
+                break
+            taskname, action, row = task
+            doneq.put(('started', me, taskname, None))
+            target_stages, qcpassed_only, actfunc = ACTIONS[action]
+            errmsg = None
+            HEARTBEAT_FILE_IDS[:] = [row['file_id']]
+            stop = threading.Event()
+            beater = threading.Thread(target=send_heartbeats,
+                                      args=(heartbeat_interval, stop))
+            beater.daemon = True
+            beater.start()
+            try:
+                actfunc(row, **action_kwargs.get(action, {}))
+            except Exception as exc:
+                sys.stderr.write("".join(traceback.format_exception(*sys.exc_info())))
+                errmsg = "%s: %s" % (type(exc).__name__, str(exc))
+            finally:
+                stop.set()
+                beater.join()
+            ntasks += 1
+            doneq.put(('finished', me, taskname, errmsg))
+    finally:
+        doneq.put(('retired', me, None, None))
+
+
+def start_workers(workers, nworkers, doneq, maxtasks=None,
+                  heartbeat_interval=60, action_kwargs={}):
+    """Make sure there are 'nworkers' worker processes.
+        (NOTE: Workers that have exited should first be removed
+            using 'reap_workers'.)
+
+        Each worker gets its own task queue, stored as the 'taskq'
+        attribute of its multiprocessing.Process object, so the
+        scheduler always knows which worker a task was given to.
+
+        Inputs:
+            workers: A list of worker multiprocessing.Process objects.
+                (NOTE: It is modified in-place)
+            nworkers: The number of workers to keep alive.
+            doneq: A multiprocessing.Queue for workers to report to.
+            maxtasks: The number of tasks each worker runs before
+                being replaced. (Default: no limit)
+            heartbeat_interval: The number of seconds between
+                heartbeats written by running tasks. (Default: 60 s)
+            action_kwargs: A dictionary of additional keyword arguments
+                to pass to each action's function, keyed by action.
+                (Default: no additional arguments)
+
+        Outputs:
+            nstarted: The number of workers started.
+    """
+    nstarted = 0
+    while len(workers) < nworkers:
+        taskq = multiprocessing.Queue()
+        proc = multiprocessing.Process(group=None, target=worker,
+                                       args=(taskq, doneq, maxtasks,
+                                             heartbeat_interval,
+                                             action_kwargs))
+        proc.taskq = taskq
+        proc.start()
+        workers.append(proc)
+        nstarted += 1
+    return nstarted
+
+
+def launch_task(db, action, row, taskq):
+    """Submit a single task acting on the relevant file
+        to the worker pool.
 
         Inputs:
             db: A Database object to use.
             action: The action to perform.
             row: A single row representing a taks to launch
+            taskq: The task queue of the worker to run the task.
 
         Outputs:
-            proc: The started multiprocessing.Process object
+            name: The name of the submitted task, or None if the
+                file was claimed by another scheduler first.
     """
     if action not in ACTIONS:
         raise errors.UnrecognizedValueError("The file action '%s' is not "
@@ -1855,42 +2372,146 @@ def launch_task(db, action, row):
                                             "are '%s'." %
                                             "', '".join(ACTIONS.keys()))
 
-    target_stages, qcpassed_only, withlock, actfunc = ACTIONS[action]
-    results = []
+    target_stages, qcpassed_only, actfunc = ACTIONS[action]
+    if not claim_file(db, row):
+        utils.print_info("File ID %d was claimed by another scheduler" %
+                         row['file_id'], 2)
+        return None
+    name = "%s.file_id:%d" % (action, row['file_id'])
+    # Rows are sent to the workers as plain dicts so they can be pickled
+    taskq.put((name, action, dict(row)))
+    return name
+
+
+def get_claimer_id():
+    """Return a string identifying this scheduler process.
+
+        Inputs:
+            None
+
+        Output:
+            claimer_id: The claimer ID (<hostname>:<PID>).
+    """
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+
+def claim_file(db, row):
+    """Atomically claim a file for processing by changing its
+        status from the status it was selected with to 'submitted'.
+        The update only succeeds if no other scheduler has changed
+        the file's status in the meantime. The original status is
+        recorded so it can be restored if the task is abandoned.
+
+        Inputs:
+            db: A Database object to use.
+            row: The file's row, as selected from the database.
+
+        Output:
+            claimed: True if the file was claimed, False otherwise.
+    """
     with db.transaction() as conn:
         update = db.files.update().\
-                    where(db.files.c.file_id == row['file_id']).\
+                    where((db.files.c.file_id == row['file_id']) &
+                          (db.files.c.status == row['status'])).\
                     values(status='submitted',
+                            claimed_status=row['status'],
+                            claimed_by=get_claimer_id(),
+                            heartbeat=datetime.datetime.now(),
                             last_modified=datetime.datetime.now())
-        conn.execute(update)
-    if withlock:
-        lock = get_caldb_lock(row['sourcename'])
-        args = (row,lock)
-    else:
-        args = (row,)
-    name = "%s.file_id:%d" % (action, row['file_id'])
-    proc = multiprocessing.Process(group=None, target=actfunc,
-                                   name=name, args=args)
-    proc.start()
-    return proc
+        result = conn.execute(update)
+        nclaimed = result.rowcount
+        result.close()
+    return nclaimed == 1
 
 
-def get_caldb_lock(sourcename):
-    """Return the lock used to access the calibrator database
-        file for the given source.
+def claim_next_stage(db, file_id):
+    """Claim a file just produced by a stage of a fused reduction
+        so that the same task can carry on with the next stage.
+        Heartbeats are written for the claimed file.
 
-        Input:
-            sourcename: The name of the source to match.
-                (NOTE: '_R' will be removed from the sourcename, if present)
+        Inputs:
+            db: A Database object to use.
+            file_id: The ID of the file to claim.
 
         Output:
-            lock: The corresponding lock.
+            row: The file's row, as selected before it was claimed,
+                or None if another scheduler claimed it first.
     """
-    name = utils.get_prefname(sourcename)
-    if name.endswith('_R'):
-        name = name[:-2]
-    lock = CALDB_LOCKS.setdefault(name, multiprocessing.Lock())
-    return lock
+    row = get_task_row(db, file_id)
+    if not claim_file(db, row):
+        utils.print_info("File ID %d was claimed by another scheduler. "
+                         "Fused reduction will not continue." % file_id, 1)
+        return None
+    HEARTBEAT_FILE_IDS.append(file_id)
+    return row
+
+
+def recover_stale_tasks(db, lease_time, max_retries):
+    """Find tasks whose lease has expired (i.e. that have not
+        written a heartbeat recently) and put them back in the
+        queue with the status they were claimed from. Tasks that
+        have already been retried 'max_retries' times are marked
+        as failed instead.
+
+        Directories that are 'running', but haven't written a
+        heartbeat for longer than the lease time, are also reset
+        to 'new'.
+
+        Inputs:
+            db: A Database object to use.
+            lease_time: The number of seconds without a heartbeat
+                after which a task is considered dead.
+            max_retries: The maximum number of times to retry a task.
+
+        Outputs:
+            nreset: The number of tasks put back in the queue.
+            nfailed: The number of tasks marked as failed.
+    """
+    now = datetime.datetime.now()
+    expiry = now - datetime.timedelta(seconds=lease_time)
+    nretries = sa.func.coalesce(db.files.c.nretries, 0)
+    is_stale = db.files.c.status.in_(['submitted', 'running']) & \
+               (sa.func.coalesce(db.files.c.heartbeat,
+                                 db.files.c.last_modified) < expiry)
+    with db.transaction() as conn:
+        update = db.files.update().\
+                    where(is_stale & (nretries >= max_retries)).\
+                    values(status='failed',
+                           note='Abandoned after %d attempts. The task '
+                                'stopped sending heartbeats.' %
+                                (max_retries+1),
+                           last_modified=now)
+        result = conn.execute(update)
+        nfailed = result.rowcount
+        result.close()
+        update = db.files.update().\
+                    where(is_stale & (nretries < max_retries)).\
+                    values(status=sa.func.coalesce(db.files.c.claimed_status,
+                                                   'new'),
+                           nretries=nretries+1,
+                           claimed_by=None,
+                           claimed_status=None,
+                           note='Lease expired. Reattempting.',
+                           last_modified=now)
+        result = conn.execute(update)
+        nreset = result.rowcount
+        result.close()
+        update = db.directories.update().\
+                    where((db.directories.c.status == 'running') &
+                          (sa.func.coalesce(db.directories.c.heartbeat,
+                                            db.directories.c.last_modified) <
+                                expiry)).\
+                    values(status='new',
+                           note='Lease expired. Reattempting.',
+                           last_modified=now)
+        result = conn.execute(update)
+        ndirs = result.rowcount
+        result.close()
+    if nreset or nfailed or ndirs:
+        utils.print_info("Recovered stale tasks: %d files put back in the "
+                         "queue; %d files marked as failed; %d directories "
+                         "put back in the queue" % (nreset, nfailed, ndirs), 0)
+    return nreset, nfailed
 
 
 def prioritize_pulsar(db, psrname):
@@ -1942,13 +2563,17 @@ def prioritize_predef_srclist(db, srclist_name):
 
 # Actions are defined by a tuple: (target stage, 
 #                                  passed quality control,
-#                                  with calibrator database lock,
 #                                  function to proceed to next step)
-ACTIONS = {'combine': (['grouped'], False, False, load_combined_file),
-           'correct': (['combined'], False, False, load_corrected_file),
-           'clean': (['corrected'], False, False, load_cleaned_file),
-           'calibrate': (['cleaned'], True, True, load_calibrated_file),
-           'load': ([], True, False, load_to_toaster)}
+ACTIONS = {'combine': (['grouped'], False, load_combined_file),
+           'correct': (['combined'], False, load_corrected_file),
+           'clean': (['corrected'], False, load_cleaned_file),
+           'reduce': (['grouped'], False, load_reduced_file),
+           'calibrate': (['cleaned'], True, load_calibrated_file),
+           'load': ([], True, load_to_toaster)}
+
+# Actions ordered from the most to the least advanced
+# stage of the reduction chain
+STAGE_ORDER = ['load', 'calibrate', 'clean', 'correct', 'combine', 'reduce']
 
 PRIORITY_FUNC = {'pulsar': prioritize_pulsar,
                  'psr': prioritize_pulsar,
@@ -1971,6 +2596,101 @@ def parse_priorities(priority_str):
     return priority_list
 
 
+def load_new_data(db, force=False, heartbeat_interval=60):
+    """Search for new raw data directories and group the
+        subints they contain.
+
+        Inputs:
+            db: A Database object to use.
+            force: Attempt to load all directories regardless
+                of modification times. (Default: False)
+            heartbeat_interval: The number of seconds between
+                heartbeats written while grouping. (Default: 60 s)
+
+        Outputs:
+            None
+    """
+    # Load raw data directories
+    print "Loading directories..."
+    ndirs = load_directories(db, force=force)
+    # Group data immediately
+    dirrows = get_togroup(db)
+    print "Grouping subints..."
+    for dirrow in utils.show_progress(dirrows, width=50):
+        try:
+            load_groups(dirrow, heartbeat_interval=heartbeat_interval)
+        except errors.CoastGuardError:
+            sys.stderr.write("".join(traceback.format_exception(*sys.exc_info())))
+
+
+def handle_reports(reports, inprogress, running):
+    """Process reports sent by workers to the scheduler.
+
+        Inputs:
+            reports: A list of (kind, worker name, task name, errmsg)
+                tuples sent by workers.
+            inprogress: A dictionary mapping the names of tasks that
+                have been submitted, but have not finished, to a
+                description of their estimated resource use.
+                (NOTE: It is modified in-place)
+            running: A dictionary mapping worker names to the
+                name of the task they were given.
+                (NOTE: It is modified in-place)
+
+        Outputs:
+            None
+    """
+    for kind, workername, taskname, errmsg in reports:
+        if kind == 'started':
+            utils.print_debug("Worker %s started %s" %
+                              (workername, taskname), 'reduce')
+        elif kind == 'finished':
+            running.pop(workername, None)
+            inprogress.pop(taskname, None)
+            if errmsg is not None:
+                sys.stderr.write("Task %s failed! %s\n" % (taskname, errmsg))
+        elif kind == 'retired':
+            utils.print_info("Worker %s retired" % workername, 2)
+
+
+def reap_workers(workers, inprogress, running):
+    """Remove workers that have exited. Tasks given to
+        workers that died are considered to have failed,
+        even if the worker never reported starting them.
+
+        Inputs:
+            workers: A list of worker multiprocessing.Process objects.
+                (NOTE: It is modified in-place)
+            inprogress: A dictionary mapping the names of tasks that
+                have been submitted, but have not finished, to a
+                description of their estimated resource use.
+                (NOTE: It is modified in-place)
+            running: A dictionary mapping worker names to the
+                name of the task they were given.
+                (NOTE: It is modified in-place)
+
+        Outputs:
+            None
+    """
+    for ii in xrange(len(workers)-1, -1, -1):
+        proc = workers[ii]
+        if proc.is_alive() or proc.exitcode is None:
+            continue
+        workers.pop(ii).join()
+        # Workers that retire normally report their last task
+        # as finished before exiting.
+        taskname = running.pop(proc.name, None)
+        if (proc.exitcode != 0) or (taskname is not None):
+            if proc.exitcode < 0:
+                msg = "With signal %d" % (-proc.exitcode)
+            else:
+                msg = "With error code %d" % proc.exitcode
+            if taskname is not None:
+                inprogress.pop(taskname, None)
+                msg += " (while running %s)" % taskname
+            sys.stderr.write("Worker %s died! %s\n" % (proc.name, msg))
+
+
 def main():
     # Share verbosity level with TOASTER
     toaster.config.cfg.verbosity = config.verbosity
@@ -1986,6 +2706,16 @@ def main():
     else:
         actions_to_perform = [act for act in ACTIONS.keys() \
                               if act not in args.actions_to_exclude]
+        # The fused 'reduce' action replaces 'combine'
+        if args.fused:
+            actions_to_perform = [act for act in actions_to_perform
+                                  if act != 'combine']
+        else:
+            actions_to_perform = [act for act in actions_to_perform
+                                  if act != 'reduce']
+
+    # Additional arguments for actions' functions
+    action_kwargs = {'reduce': {'keep_intermediates': args.keep_intermediates}}
 
     global mjd_to_receiver
     if args.lband_rcvr_map is not None:
@@ -1993,71 +2723,155 @@ def main():
     else:
         mjd_to_receiver = None
 
-    inprogress = []
+    # Tasks that have been submitted but are not finished.
+    # Keys are task names. Values are dictionaries with keys:
+    #     'mem': Estimated memory use (in bytes).
+    #     'disk': Estimated disk use (see 'estimate_disk_usage').
+    #     'share': Fair-share key (see 'get_share_key').
+    inprogress = {}
+    # Actions paused because of a lack of disk space
+    paused = {}
+    min_free = args.min_free_space*1024.0**3
+    if args.mem_budget is None:
+        mem_budget = get_memory_budget()
+    else:
+        mem_budget = args.mem_budget*1024.0**3
+    # Names of tasks given to each worker
+    running = {}
+    workers = []
+    # Tasks are handed to each worker through its own queue
+    # (see 'start_workers'). Workers report back through 'doneq'
+    doneq = multiprocessing.Queue()
     try:
         priority_list = []
         for priority_str in args.priority:
             priority_list.extend(parse_priorities(priority_str))
         db = database.Database()
+        # Look up the version ID once, before any workers are started.
+        # Workers inherit the cached git hashes and version ID, so they
+        # don't need to run git themselves.
+        utils.get_version_id(db)
 
-        # Load raw data directories
-        print "Loading directories..."
-        ndirs = load_directories(db, force=args.reattempt_dirs)
-        # Group data immediately
-        dirrows = get_togroup(db)
-        print "Grouping subints..."
-        for dirrow in utils.show_progress(dirrows, width=50):
-            try:
-                load_groups(dirrow)
-            except errors.CoastGuardError:
-                sys.stderr.write("".join(traceback.format_exception(*sys.exc_info())))
+        recover_stale_tasks(db, args.lease_time, args.max_retries)
+        # Check for expired leases 4 times per lease period
+        next_recovery = time.time() + args.lease_time/4.0
+
+        load_new_data(db, force=args.reattempt_dirs,
+                      heartbeat_interval=args.heartbeat_interval)
+        next_rescan = time.time() + args.rescan_time
 
         # Turn off progress counters before we enter the main loop
         config.show_progress = False
 
         print "Entering main loop..."
         while True:
-            nfree = args.numproc - len(inprogress)
+            reap_workers(workers, inprogress, running)
+            start_workers(workers, args.numproc, doneq,
+                          maxtasks=args.max_tasks,
+                          heartbeat_interval=args.heartbeat_interval,
+                          action_kwargs=action_kwargs)
+            if time.time() >= next_recovery:
+                recover_stale_tasks(db, args.lease_time, args.max_retries)
+                next_recovery = time.time() + args.lease_time/4.0
+            if time.time() >= next_rescan:
+                # Look for newly arrived raw data
+                load_new_data(db, heartbeat_interval=args.heartbeat_interval)
+                next_rescan = time.time() + args.rescan_time
+            # Workers that haven't been given a task
+            idle = [proc for proc in workers if proc.name not in running]
+            nfree = min(args.numproc - len(inprogress), len(idle))
             nsubmit = 0
             if nfree:
                 utils.print_info("Will perform the following actions: %s" % 
                                  ", ".join(actions_to_perform), 1)
+                candidates = []
                 for action in actions_to_perform:
                     if action == 'load':
-                        rows = get_toload(db)[:nfree]
+                        rows = get_toload(db)
                     else:
                         rows = get_todo(db, action,
-                                        priorities=priority_list)[:nfree]
-                    for row in rows:
-                        proc = launch_task(db, action, row)
-                        inprogress.append(proc)
-                    nnew = len(rows)
-                    nfree -= nnew
-                    nsubmit += nnew
+                                        priorities=priority_list)
+                    if not rows:
+                        paused.pop(action, None)
+                    candidates.extend([(action, row) for row in rows])
+                recent_mjd = rs.utils.mjdnow() - args.recent_hours/24.0
+                nlaunched = dict([(action, 0) for action in actions_to_perform])
+                # Actions without enough disk space in this iteration
+                blocked = set()
+                for action, row in schedule_tasks(candidates, inprogress,
+                                                  recent_mjd):
+                    if nsubmit >= nfree:
+                        break
+                    if action in blocked:
+                        continue
+                    mem = estimate_memory(action, row)
+                    memused = sum([task['mem'] for task in inprogress.values()])
+                    if inprogress and (memused+mem > mem_budget):
+                        # Not enough memory for this task. Look
+                        # for a smaller one to fill the space.
+                        # (A task is always admitted if nothing
+                        # else is running.)
+                        continue
+                    needs = estimate_disk_usage(action, row)
+                    ok, msg = check_disk_space(needs,
+                                    [task['disk'] for task in inprogress.values()],
+                                    min_free)
+                    if not ok:
+                        # Pause this action until there is space
+                        if action not in paused:
+                            utils.print_info("Pausing '%s' tasks. Not "
+                                             "enough disk space: %s" %
+                                             (action, msg), 0)
+                        paused[action] = msg
+                        blocked.add(action)
+                        continue
+                    elif action in paused:
+                        del paused[action]
+                        utils.print_info("Resuming '%s' tasks" % action, 0)
+                    proc = idle[nsubmit]
+                    taskname = launch_task(db, action, row, proc.taskq)
+                    if taskname is not None:
+                        running[proc.name] = taskname
+                        inprogress[taskname] = {'mem': mem,
+                                                'disk': needs,
+                                                'share': get_share_key(row)}
+                        nlaunched[action] += 1
+                        nsubmit += 1
+                for action, nnew in nlaunched.iteritems():
                     if nnew:
                         utils.print_info("Launched %d '%s' tasks" %
                                          (nnew, action), 0)
-            utils.print_info("[%s] - Num running: %d; Num submitted: %d" %
-                        (datetime.datetime.now(), len(inprogress), nsubmit), 0)
-            # Sleep between iterations
-            time.sleep(args.sleep_time)
+            utils.print_info("[%s] - Num running: %d; Num submitted: %d; "
+                             "Est. memory in use: %.1f of %.1f GB" %
+                        (datetime.datetime.now(), len(inprogress), nsubmit,
+                         sum([task['mem'] for task in inprogress.values()])/1024.0**3,
+                         mem_budget/1024.0**3), 0)
+            for action, msg in paused.iteritems():
+                utils.print_info("'%s' tasks are paused. Not enough "
+                                 "disk space: %s" % (action, msg), 0)
+            # Wait for a task to finish, but re-check for new work
+            # at least every 'sleep_time' seconds, and in time for
+            # the next rescan of the raw data directories and the
+            # next check for expired leases.
+            timeout = min(args.sleep_time,
+                          max(min(next_rescan, next_recovery) - time.time(), 0))
+            reports = []
+            try:
+                reports.append(doneq.get(timeout=timeout))
+                # Collect any other reports sent in the meantime
+                while True:
+                    reports.append(doneq.get_nowait())
+            except Queue.Empty:
+                pass
             # Check for completed tasks
-            for ii in xrange(len(inprogress)-1, -1, -1):
-                proc = inprogress[ii]
-                #print "Checking %s" % proc.name
-                #print "Is alive: %s; Exitcode: %s" % \
-                #        (proc.is_alive(), proc.exitcode)
-                if not proc.is_alive() and proc.exitcode is not None:
-                    if proc.exitcode != 0:
-                        if proc.exitcode < 0:
-                            msg = "With signal %d" % (-proc.exitcode)
-                        else:
-                            msg = "With error code %d" % proc.exitcode
-                        sys.stderr.write("Process failed! %s\n" % msg)
-                    inprogress.pop(ii)
+            handle_reports(reports, inprogress, running)
     except:
         # Re-raise the error
         raise
+    finally:
+        # Tell the workers to stop once their current task is done
+        for proc in workers:
+            proc.taskq.put(None)
 
 
 if __name__ == '__main__':
@@ -2065,11 +2879,56 @@ if __name__ == '__main__':
                                     "of Asterix data.")
     parser.add_argument("-P", "--num-procs", dest='numproc', type=int,
                         default=1,
-                        help="Number of processes to run simultaneously.")
+                        help="Maximum number of processes to run "
+                             "simultaneously. Fewer may run if the memory "
+                             "budget is used up.")
+    parser.add_argument("--mem-budget", dest='mem_budget', type=float,
+                        default=None,
+                        help="Amount of memory (in GB) that running tasks "
+                             "may use, based on estimates from the size of "
+                             "each task's input data. (Default: 80%% of "
+                             "physical memory)")
+    parser.add_argument("--max-tasks-per-worker", dest='max_tasks', type=int,
+                        default=100,
+                        help="Number of tasks a worker process runs before "
+                             "it is replaced by a fresh process. "
+                             "(Default: 100)")
+    parser.add_argument("--min-free-space", dest='min_free_space',
+                        type=float, default=10,
+                        help="Amount of disk space (in GB) to keep free on "
+                             "the output and temporary filesystems. Stages "
+                             "that would use this space are paused until "
+                             "space is available. (Default: 10 GB)")
     parser.add_argument("-t", "--sleep-time", dest='sleep_time', type=int,
                         default=300,
-                        help="Number of seconds to sleep between iterations "
-                             "of the main loop. (Default: 300s)")
+                        help="Maximum number of seconds to wait for a task "
+                             "to finish before checking the database for "
+                             "new work. Free slots are refilled as soon as "
+                             "a task finishes. (Default: 300s)")
+    parser.add_argument("--rescan-time", dest='rescan_time', type=int,
+                        default=3600,
+                        help="Number of seconds between searches for new "
+                             "raw data directories. (Default: 3600s)")
+    parser.add_argument("--heartbeat-interval", dest='heartbeat_interval',
+                        type=int, default=60,
+                        help="Number of seconds between heartbeats written "
+                             "to the database by running tasks. "
+                             "(Default: 60s)")
+    parser.add_argument("--lease-time", dest='lease_time', type=int,
+                        default=3600,
+                        help="Number of seconds without a heartbeat after "
+                             "which a running task is considered dead and "
+                             "is put back in the queue. (Default: 3600s)")
+    parser.add_argument("--max-retries", dest='max_retries', type=int,
+                        default=2,
+                        help="Number of times a task whose lease expired is "
+                             "put back in the queue before it is marked as "
+                             "failed. (Default: 2)")
+    parser.add_argument("--recent-hours", dest='recent_hours', type=float,
+                        default=24,
+                        help="Observations that started within this many "
+                             "hours are processed before older observations. "
+                             "(Default: 24 hours)")
     parser.add_argument("--prioritize", action='append',
                         default=[], dest='priority',
                         help="A rule for prioritizing observations.")
@@ -2087,6 +2946,18 @@ if __name__ == '__main__':
                           help="Only perform the given action. Must be one of '%s'. "
                                "(Default: perform all actions.)" %
                                "', '".join(ACTIONS.keys()))
+    parser.add_argument("--fused", dest='fused', action='store_true',
+                        help="Combine, correct and clean each observation "
+                             "in a single task (the 'reduce' action), "
+                             "keeping the archive in memory between "
+                             "stages. (Default: run each stage as a "
+                             "separate task.)")
+    parser.add_argument("--keep-intermediates", dest='keep_intermediates',
+                        action='store_true',
+                        help="When combining, correcting and cleaning in a "
+                             "single task, keep the combined and corrected "
+                             "files. (Default: delete them once the "
+                             "cleaned file is loaded.)")
     parser.add_argument("--lband-rcvr-map", dest='lband_rcvr_map', type=str,
                         default=None,
                         help="A text file containing MJD to receiver mapping. "
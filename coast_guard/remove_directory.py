@@ -220,6 +220,11 @@ def main():
                             where(db.diagnostics.c.diagnostic_id.in_(diag_ids))
                 results = conn.execute(delete)
                 results.close()
+                # Remove audit states of the files
+                delete = db.file_audits.delete().\
+                            where(db.file_audits.c.file_id.in_(file_ids))
+                results = conn.execute(delete)
+                results.close()
                 # Remove file entries 
                 # (newest first because of foreign key constraints - parent_file_id column)
                 for file_id in reversed(sorted(file_ids)):
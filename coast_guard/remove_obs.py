@@ -205,6 +205,11 @@ def main():
                             where(db.diagnostics.c.diagnostic_id.in_(diag_ids))
                 results = conn.execute(delete)
                 results.close()
+                # Remove audit states of the files
+                delete = db.file_audits.delete().\
+                            where(db.file_audits.c.file_id.in_(file_ids))
+                results = conn.execute(delete)
+                results.close()
                 # Remove any quality control entries in the database
                 delete = db.qctrl.delete().\
                             where(db.qctrl.c.qctrl_id.in_(qctrl_ids))
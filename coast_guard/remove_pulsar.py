@@ -92,6 +92,13 @@ def main():
                 conn.execute(delete)
                 results.close()
 
+            # Remove audit states of the files
+            if filerows:
+                delete = db.file_audits.delete().\
+                        where(db.file_audits.c.file_id.in_(
+                                [row['file_id'] for row in filerows]))
+                conn.execute(delete)
+
             # Remove files entries
             print "Removing file rows"
             for row in utils.show_progress(filerows, width=50, tot=len(filerows)):
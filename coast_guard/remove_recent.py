@@ -55,6 +55,13 @@ def main():
         print "There are %d entires to be removed from logs table" % \
             len(logsrows)
         if not args.dryrun:
+            # Remove audit states of the files
+            if filerows:
+                delete = db.file_audits.delete().\
+                            where(db.file_audits.c.file_id.in_(
+                                    [row['file_id'] for row in filerows]))
+                results = conn.execute(delete)
+                results.close()
             for row in utils.show_progress(filerows, width=50, tot=len(filerows)):
                 ff = os.path.join(row['filepath'], row['filename'])
                 try:
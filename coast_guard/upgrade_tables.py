@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""
+Bring the tables of an existing database up to date with
+the schema defined in the 'database' package. Missing tables
+are created, and missing columns and indices are added to
+existing tables. Existing columns and data are not modified,
+except that new columns derived from existing ones are filled in.
+"""
+
+import sqlalchemy as sa
+
+import database
+import utils
+import config
+
+
+def add_missing_columns(engine, metadata):
+    """Add columns and indices that are defined in the metadata
+        but are missing from existing tables in the database.
+
+        NOTE: New columns must be nullable, or have a server-side
+            default, to be added to tables that already have rows.
+
+        Inputs:
+            engine: The database engine to use.
+            metadata: The sa.MetaData object describing the tables.
+
+        Outputs:
+            nadded: The number of columns and indices added.
+    """
+    inspector = sa.engine.reflection.Inspector.from_engine(engine)
+    existing_tables = inspector.get_table_names()
+    nadded = 0
+    with engine.begin() as conn:
+        for table in metadata.sorted_tables:
+            if table.name not in existing_tables:
+                # The table will be created by 'create_all'
+                continue
+            existing = set([col['name'] for col
+                            in inspector.get_columns(table.name)])
+            for col in table.columns:
+                if col.name in existing:
+                    continue
+                colspec = sa.schema.CreateColumn(col).compile(dialect=engine.dialect)
+                utils.print_info("Adding column '%s' to table '%s'" %
+                                 (col.name, table.name), 1)
+                conn.execute("ALTER TABLE %s ADD COLUMN %s" %
+                             (table.name, colspec))
+                nadded += 1
+            existing = set([idx['name'] for idx
+                            in inspector.get_indexes(table.name)])
+            for idx in table.indexes:
+                if idx.name in existing:
+                    continue
+                utils.print_info("Adding index '%s' to table '%s'" %
+                                 (idx.name, table.name), 1)
+                idx.create(bind=conn)
+                nadded += 1
+    return nadded
+
+
+def backfill_obslog(engine, metadata):
+    """Fill in the native timestamp column of observing log
+        entries that only have the string timestamp.
+
+        Inputs:
+            engine: The database engine to use.
+            metadata: The sa.MetaData object describing the tables.
+
+        Outputs:
+            nfilled: The number of rows filled in.
+    """
+    obsinfo = metadata.tables['obsinfo']
+    with engine.begin() as conn:
+        update = obsinfo.update().\
+                    where(obsinfo.c.obsutc == None).\
+                    values(obsutc=sa.cast(obsinfo.c.obstimestamp,
+                                          sa.DateTime))
+        result = conn.execute(update)
+        nfilled = result.rowcount
+        result.close()
+    return nfilled
+
+
+def main():
+    if args.db == 'obslog':
+        url = config.obslog_dburl
+        metadata = database.obslog.metadata
+    else:
+        url = config.dburl
+        metadata = database.schema.metadata
+    engine = database.get_engine(url)
+    # Create tables that don't exist yet
+    metadata.create_all(engine)
+    nadded = add_missing_columns(engine, metadata)
+    print "Added %d columns/indices to existing tables" % nadded
+    if args.db == 'obslog':
+        nfilled = backfill_obslog(engine, metadata)
+        print "Filled in timestamps of %d observing log entries" % nfilled
+
+
+if __name__ == '__main__':
+    parser = utils.DefaultArguments(\
+                description="Add missing tables, columns and indices "
+                            "to an existing database.")
+    parser.add_argument("--db", dest='db', default='effreduce',
+                        choices=['effreduce', 'obslog'],
+                        help="The database to upgrade. "
+                             "(Default: effreduce)")
+    args = parser.parse_args()
+    main()
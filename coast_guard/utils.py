@@ -12,6 +12,8 @@ import glob
 import optparse
 import sys
 import subprocess
+import signal
+import time
 import types
 import inspect
 import datetime
@@ -19,6 +21,9 @@ import argparse
 import string
 import tempfile
 import stat
+import shutil
+import threading
+import cPickle
 
 import numpy as np
 
@@ -237,10 +242,14 @@ jname_cache = {}
 prefname_cache = {}
 # A cache for version IDs
 versionid_cache = {}
+# A cache for git hashes, keyed by the state of the repositories
+githash_cache = {}
 # A cache for fluxcal names
 __fluxcals = None
 # A cache for psrchive configurations
 __psrchive_configs = None
+# A cache for the index of the pulsar catalogue
+__psrcat_index = None
 
 def get_psrchive_configs():
     global __psrchive_configs
@@ -291,6 +300,191 @@ def read_fluxcal_names(fluxcalfn=None):
     return __fluxcals
 
 
+def get_psrcat_dbfile():
+    """Return the name of the pulsar catalogue database file
+        used by 'psrcat'. The file is given by the 'psrcat_db'
+        configuration, or the 'PSRCAT_FILE' environment variable.
+
+        Inputs:
+            None
+
+        Output:
+            dbfn: The catalogue file name. None if it isn't known.
+    """
+    return getattr(config, 'psrcat_db', None) or os.getenv('PSRCAT_FILE')
+
+
+def read_psrcat_db(dbfn):
+    """Read the pulsar catalogue database file and build an
+        index of its entries by name.
+
+        Input:
+            dbfn: The catalogue file name.
+
+        Output:
+            index: A dictionary with keys:
+                'entries': A list of dictionaries, one per pulsar,
+                    with keys 'jname', 'bname', 'flux' and 'spindex'.
+                'names': A dictionary mapping J-names, B-names and
+                    aliases to indices into 'entries'.
+    """
+    params = []
+    entry = {}
+    with open(dbfn, 'r') as ff:
+        for line in ff:
+            if line.startswith('@'):
+                # End of entry
+                if entry:
+                    params.append(entry)
+                entry = {}
+                continue
+            if line.startswith('#') or not line.strip():
+                continue
+            split = line.split()
+            entry[split[0]] = split[1:]
+    if entry:
+        params.append(entry)
+
+    index = {'entries': [], 'names': {}}
+    for entry in params:
+        if 'PSRJ' not in entry:
+            continue
+        flux = entry.get('S1400')
+        spindex = None
+        if entry.get('SPINDX'):
+            try:
+                spindex = float(entry['SPINDX'][0])
+            except ValueError:
+                pass
+        index['entries'].append({'jname': entry['PSRJ'][0],
+                                 'bname': (entry.get('PSRB') or [None])[0],
+                                 'flux': tuple(flux) if flux else None,
+                                 'spindex': spindex})
+        ientry = len(index['entries'])-1
+        names = entry['PSRJ'][:1] + entry.get('PSRB', [])[:1] + \
+                    entry.get('ALIAS', [])
+        for name in names:
+            index['names'].setdefault(name, []).append(ientry)
+    return index
+
+
+def get_cache_dir():
+    """Return the directory where parsed files are cached between
+        processes. The directory is private to the current user
+        (mode 0700) and is created inside the configured temporary
+        directory if it doesn't already exist.
+
+        The cache is only used if the directory is owned by the
+        current user and isn't accessible by anyone else, so cached
+        files can't be planted or tampered with by other users.
+
+        Inputs:
+            None
+
+        Output:
+            cachedir: The cache directory. None if no suitable
+                directory is available.
+    """
+    tmpdir = getattr(config, 'tmp_directory', None) or tempfile.gettempdir()
+    cachedir = os.path.join(tmpdir, "coast_guard_cache_%d" % os.getuid())
+    try:
+        os.mkdir(cachedir, 0700)
+    except OSError:
+        # Directory already exists. It is checked below.
+        pass
+    try:
+        # Use 'lstat' so a symbolic link is never followed
+        st = os.lstat(cachedir)
+    except OSError:
+        return None
+    if not stat.S_ISDIR(st.st_mode) or (st.st_uid != os.getuid()) or \
+                (st.st_mode & (stat.S_IRWXG | stat.S_IRWXO)):
+        warnings.warn("Not caching files. Cache directory (%s) is not "
+                      "a private directory owned by the current user." %
+                      cachedir, errors.CoastGuardWarning)
+        return None
+    return cachedir
+
+
+def get_psrcat_index():
+    """Return an index of the pulsar catalogue (see 'read_psrcat_db').
+        The index is pickled in the user's private cache directory
+        (see 'get_cache_dir') so the catalogue only needs to be read
+        once, and it is rebuilt whenever the catalogue file's
+        modification time changes.
+
+        Inputs:
+            None
+
+        Output:
+            index: The catalogue index. None if the catalogue
+                file isn't known or doesn't exist.
+    """
+    global __psrcat_index
+    dbfn = get_psrcat_dbfile()
+    if (dbfn is None) or not os.path.isfile(dbfn):
+        return None
+    dbfile = (os.path.abspath(dbfn), os.path.getmtime(dbfn))
+    if (__psrcat_index is not None) and (__psrcat_index['dbfile'] == dbfile):
+        return __psrcat_index
+
+    cachedir = get_cache_dir()
+    index = None
+    if cachedir is not None:
+        picklefn = os.path.join(cachedir, "psrcat_%s.pkl" %
+                                hashlib.md5(dbfile[0]).hexdigest())
+        try:
+            with open(picklefn, 'rb') as ff:
+                index = cPickle.load(ff)
+        except Exception:
+            # Missing or unreadable. It will be rebuilt.
+            pass
+    if (index is None) or (index.get('dbfile') != dbfile):
+        print_info("Indexing pulsar catalogue (%s)" % dbfn, 2)
+        index = read_psrcat_db(dbfn)
+        index['dbfile'] = dbfile
+        if cachedir is not None:
+            # Write to a temporary file first so other processes
+            # never read a partially written index
+            try:
+                fd, tmpfn = tempfile.mkstemp(dir=cachedir, prefix=".psrcat")
+                with os.fdopen(fd, 'wb') as ff:
+                    cPickle.dump(index, ff, cPickle.HIGHEST_PROTOCOL)
+                os.rename(tmpfn, picklefn)
+            except (IOError, OSError):
+                warnings.warn("Could not save pulsar catalogue index (%s)" %
+                              picklefn, errors.CoastGuardWarning)
+    __psrcat_index = index
+    return __psrcat_index
+
+
+def search_psrcat_index(search):
+    """Find entries in the pulsar catalogue index matching
+        a 'psrcat' search pattern. A trailing '*' matches
+        any J-name or B-name starting with the pattern, with
+        or without its leading 'J'/'B'.
+
+        Input:
+            search: The search pattern.
+
+        Output:
+            entries: A list of matching entries (see 'read_psrcat_db').
+                None if there is no catalogue index.
+    """
+    index = get_psrcat_index()
+    if index is None:
+        return None
+    if search.endswith('*'):
+        prefix = search[:-1]
+        ientries = set()
+        for name, inds in index['names'].iteritems():
+            if name.startswith(prefix) or name[1:].startswith(prefix):
+                ientries.update(inds)
+    else:
+        ientries = set(index['names'].get(search, []))
+    return [index['entries'][ii] for ii in sorted(ientries)]
+
+
 def show_progress(iterator, width=0, tot=None):
     """Wrap an iterator so that a progress counter is printed
         as we iterate.
@@ -520,6 +714,78 @@ def get_md5sum(fn, block_size=16*8192):
     return md5.hexdigest()
 
 
+def copy_file(src, dest, block_size=16*8192):
+    """Copy a file, computing its MD5 sum as the data are
+        streamed, so the file does not need to be read again
+        to get its checksum. The copy is written to a temporary
+        file in the destination directory, which is then renamed,
+        so 'dest' never refers to a partially written file.
+
+        Inputs:
+            src: The file to copy.
+            dest: The name of the copy.
+            block_size: The number of bytes to read at a time.
+                (Default: 16*8192)
+
+        Output:
+            md5: The hexidecimal string of the MD5 checksum.
+    """
+    md5 = hashlib.md5()
+    fd, tmpfn = tempfile.mkstemp(dir=os.path.dirname(dest),
+                                 prefix=".%s." % os.path.basename(dest))
+    try:
+        with os.fdopen(fd, 'wb') as outff:
+            with open(src, 'rb') as inff:
+                block = inff.read(block_size)
+                while block:
+                    md5.update(block)
+                    outff.write(block)
+                    block = inff.read(block_size)
+        shutil.copymode(src, tmpfn)
+        os.rename(tmpfn, dest)
+    except:
+        if os.path.exists(tmpfn):
+            os.remove(tmpfn)
+        raise
+    return md5.hexdigest()
+
+
+def move_file(src, dest, md5sum=None, block_size=16*8192):
+    """Move a file. If the source and destination are on
+        the same device the file is renamed, which is atomic
+        and does not touch the data. Otherwise the file is
+        copied (see 'copy_file') and the original removed.
+
+        Inputs:
+            src: The file to move.
+            dest: The new name of the file.
+            md5sum: The expected MD5 sum of the file. If the
+                file is copied and its checksum doesn't match
+                the copy is removed and the original is kept.
+                (Default: don't check the checksum)
+            block_size: The number of bytes to read at a time
+                when copying. (Default: 16*8192)
+
+        Output:
+            md5: The hexidecimal string of the MD5 checksum
+                computed while copying. None if the file
+                was renamed.
+    """
+    destdir = os.path.dirname(dest) or os.curdir
+    if os.stat(src).st_dev == os.stat(destdir).st_dev:
+        os.rename(src, dest)
+        md5 = None
+    else:
+        md5 = copy_file(src, dest, block_size)
+        if (md5sum is not None) and (md5 != md5sum):
+            os.remove(dest)
+            raise errors.BadFile("MD5 sum of copied file (%s) doesn't "
+                                 "match the expected value (%s). "
+                                 "Not moving %s." % (md5, md5sum, src))
+        os.remove(src)
+    return md5
+
+
 def get_version_id(db):
     """Get the version ID number from the database.
         If the version number isn't in the database, add it.
@@ -531,21 +797,29 @@ def get_version_id(db):
             version_id: The version ID for the current pipeline/psrchive
                 combination.
     """
-    # Check to make sure the repositories are clean
-    is_gitrepo_dirty(config.coastguard_repo)
-    is_gitrepo_dirty(config.psrchive_repo)
-    # Get git hashes
-    coastguard_githash = get_githash(config.coastguard_repo)
-    if is_gitrepo(config.psrchive_repo):
-        psrchive_githash = get_githash(config.psrchive_repo)
+    # Only run git if the repositories have changed since
+    # the hashes were last looked up
+    state = (get_gitrepo_state(config.coastguard_repo),
+             get_gitrepo_state(config.psrchive_repo))
+    if state in githash_cache:
+        coastguard_githash, psrchive_githash = githash_cache[state]
     else:
-        warnings.warn("PSRCHIVE directory (%s) is not a git repository! " \
-                        "Falling back to 'psrchive --version' for version " \
-                        "information." % config.psrchive_repo, \
-                        errors.CoastGuardWarning)
-        cmd = ["psrchive", "--version"]
-        stdout, stderr = execute(cmd)
-        psrchive_githash = stdout.strip()
+        # Check to make sure the repositories are clean
+        is_gitrepo_dirty(config.coastguard_repo)
+        is_gitrepo_dirty(config.psrchive_repo)
+        # Get git hashes
+        coastguard_githash = get_githash(config.coastguard_repo)
+        if is_gitrepo(config.psrchive_repo):
+            psrchive_githash = get_githash(config.psrchive_repo)
+        else:
+            warnings.warn("PSRCHIVE directory (%s) is not a git repository! " \
+                            "Falling back to 'psrchive --version' for version " \
+                            "information." % config.psrchive_repo, \
+                            errors.CoastGuardWarning)
+            cmd = ["psrchive", "--version"]
+            stdout, stderr = execute(cmd)
+            psrchive_githash = stdout.strip()
+        githash_cache[state] = (coastguard_githash, psrchive_githash)
   
     if (coastguard_githash, psrchive_githash) in versionid_cache:
         version_id = versionid_cache[(coastguard_githash, psrchive_githash)]
@@ -589,6 +863,47 @@ def get_version_id(db):
     return version_id
 
 
+def get_gitrepo_state(repodir=None):
+    """Return a fingerprint of a git repository's state, without
+        running git. The fingerprint changes when HEAD moves, when
+        the current branch is updated, or when the index changes.
+
+        Inputs:
+            repodir: Directory containing repository to check.
+
+        Output:
+            state: A tuple identifying the repository's state. None
+                if the directory is not inside a git repository.
+    """
+    if repodir is None:
+        # Use directory containing this file
+        repodir = os.path.split(__file__)[0]
+    # Find the '.git' directory
+    topdir = os.path.abspath(repodir)
+    while not os.path.isdir(os.path.join(topdir, '.git')):
+        parent = os.path.dirname(topdir)
+        if parent == topdir:
+            return None
+        topdir = parent
+    gitdir = os.path.join(topdir, '.git')
+    try:
+        with open(os.path.join(gitdir, 'HEAD')) as ff:
+            head = ff.read().strip()
+    except IOError:
+        return None
+    paths = [os.path.join(gitdir, 'index'),
+             os.path.join(gitdir, 'packed-refs')]
+    if head.startswith('ref:'):
+        paths.append(os.path.join(gitdir, head[4:].strip()))
+    state = [gitdir, head]
+    for path in paths:
+        try:
+            state.append(os.stat(path).st_mtime)
+        except OSError:
+            state.append(None)
+    return tuple(state)
+
+
 def get_githash(repodir=None):
     """Get the git hash of a repository.
 
@@ -723,7 +1038,66 @@ def exclude_files(file_list, to_exclude):
     return [f for f in file_list if f not in to_exclude]
 
 
-def execute(cmd, stdout=subprocess.PIPE, stderr=sys.stderr, dir=None): 
+def get_execute_timeout(cmd):
+    """Get the timeout for a command. Timeouts are set per
+        program by the 'execute_timeouts' configuration (a
+        dictionary mapping program names to seconds). Programs
+        not listed use the 'default_execute_timeout' configuration.
+
+        Input:
+            cmd: The command (a string or a list of arguments).
+
+        Output:
+            timeout: The number of seconds the command is allowed
+                to run for. None if there is no limit.
+    """
+    if type(cmd) == types.StringType:
+        args = cmd.split()
+    else:
+        args = cmd
+    if not args:
+        return None
+    program = os.path.basename(args[0])
+    timeouts = getattr(config, 'execute_timeouts', {})
+    return timeouts.get(program, getattr(config, 'default_execute_timeout', None))
+
+
+def stop_process(pipe, grace_period, state):
+    """Stop a process (and its children) that has run for too long.
+        It is first asked to terminate (SIGTERM). If it is still
+        running after 'grace_period' seconds it is killed (SIGKILL).
+
+        Inputs:
+            pipe: The subprocess.Popen object. The process must
+                lead its own process group.
+            grace_period: The number of seconds to wait before
+                killing the process.
+            state: A dictionary. Its 'timedout' key is set to True
+                if the process had to be stopped.
+
+        Outputs:
+            None
+    """
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        if pipe.poll() is not None:
+            # Process is already gone
+            return
+        try:
+            os.killpg(pipe.pid, sig)
+        except OSError:
+            # Process is already gone
+            return
+        state['timedout'] = True
+        waited = 0.0
+        while (pipe.poll() is None) and (waited < grace_period):
+            time.sleep(0.1)
+            waited += 0.1
+        if pipe.returncode is not None:
+            return
+
+
+def execute(cmd, stdout=subprocess.PIPE, stderr=sys.stderr, dir=None,
+            timeout=None):
     """Execute the command 'cmd' after logging the command
         to STDOUT. Execute the command in the directory 'dir',
         which defaults to the current directory is not provided.
@@ -734,11 +1108,18 @@ def execute(cmd, stdout=subprocess.PIPE, stderr=sys.stderr, dir=None):
         By default stdout is subprocess.PIPE and stderr is sent 
         to sys.stderr.
 
+        If the command runs for longer than 'timeout' seconds it
+        is terminated, then killed if it doesn't exit, and
+        errors.SystemCallTimeout is raised. By default the timeout
+        is looked up by program name (see 'get_execute_timeout').
+
         Returns (stdoutdata, stderrdata). These will both be None, 
         unless subprocess.PIPE is provided.
     """
     # Log command to stdout
     print_debug("'%s'" % cmd, 'syscalls', stepsback=2)
+    if timeout is None:
+        timeout = get_execute_timeout(cmd)
 
     stdoutfile = False
     stderrfile = False
@@ -754,9 +1135,27 @@ def execute(cmd, stdout=subprocess.PIPE, stderr=sys.stderr, dir=None):
         shell=True
     else:
         shell=False
+    if timeout:
+        # Run the command in its own process group so it can be
+        # stopped along with any children (e.g. of a shell)
+        preexec_fn = os.setsid
+    else:
+        preexec_fn = None
     pipe = subprocess.Popen(cmd, shell=shell, cwd=dir, \
-                            stdout=stdout, stderr=subprocess.PIPE)
-    (stdoutdata, stderrdata) = pipe.communicate()
+                            stdout=stdout, stderr=subprocess.PIPE, \
+                            preexec_fn=preexec_fn)
+    state = {'timedout': False}
+    if timeout:
+        grace_period = getattr(config, 'execute_grace_period', 10)
+        watchdog = threading.Timer(timeout, stop_process, \
+                                   args=(pipe, grace_period, state))
+        watchdog.daemon = True
+        watchdog.start()
+    try:
+        (stdoutdata, stderrdata) = pipe.communicate()
+    finally:
+        if timeout:
+            watchdog.cancel()
     
     # Close file objects, if any
     if stdoutfile:
@@ -766,7 +1165,12 @@ def execute(cmd, stdout=subprocess.PIPE, stderr=sys.stderr, dir=None):
         stderr.close()
     
     retcode = pipe.returncode
-    if retcode < 0:
+    if state['timedout']:
+        raise errors.SystemCallTimeout("Execution of command (%s) " \
+                                    "timed out after %g s and was " \
+                                    "stopped (status: %s)!" % \
+                                (cmd, timeout, retcode))
+    elif retcode < 0:
         raise errors.SystemCallError("Execution of command (%s) " \
                                     "terminated by signal (%s)!" % \
                                 (cmd, -retcode))
@@ -948,19 +1352,24 @@ def get_flux_density(name):
     if not name[0] in ('J', 'B') and len(name)==7:
         # Could be B-name, or truncated J-name. Add wildcard at end just in case.
         search += '*'
-    try:   
-        cmd = ['psrcat', '-nohead', '-nonumber', '-c', 'S1400', \
-                        '-null', '', search]
-        stdout, stderr = execute(cmd)
-        lines = [line for line in stdout.split('\n') \
-                    if line.strip() and not line.startswith("WARNING:")]
-        fluxes = [line.strip().split() for line in lines]
-    except errors.SystemCallError:
-        warnings.warn("Error occurred while trying to run 'psrcat' " \
-                        "to get L-band flux density for '%s'" % \
-                        name, \
-                        errors.CoastGuardWarning)
-        fluxes = []
+    entries = search_psrcat_index(search)
+    if entries is not None:
+        fluxes = [list(entry['flux']) for entry in entries if entry['flux']]
+        lines = [" ".join(flux) for flux in fluxes]
+    else:
+        try:   
+            cmd = ['psrcat', '-nohead', '-nonumber', '-c', 'S1400', \
+                            '-null', '', search]
+            stdout, stderr = execute(cmd)
+            lines = [line for line in stdout.split('\n') \
+                        if line.strip() and not line.startswith("WARNING:")]
+            fluxes = [line.strip().split() for line in lines]
+        except errors.SystemCallError:
+            warnings.warn("Error occurred while trying to run 'psrcat' " \
+                            "to get L-band flux density for '%s'" % \
+                            name, \
+                            errors.CoastGuardWarning)
+            fluxes = []
     
     if len(fluxes) == 1:
         if len(fluxes[0]) != 3:
@@ -994,18 +1403,24 @@ def get_spectral_index(name):
     if not name[0] in ('J', 'B') and len(name)==7:
         # Could be B-name, or truncated J-name. Add wildcard at end just in case.
         search += '*'
-    try:   
-        cmd = ['psrcat', '-nohead', '-nonumber', '-c', 'SPINDX', \
-                        '-o', 'short', '-null', '', search]
-        stdout, stderr = execute(cmd)
-        lines = [line for line in stdout.split('\n') \
-                    if line.strip() and not line.startswith("WARNING:")]
-        spinds = [float(line.strip()) for line in lines]
-    except errors.SystemCallError:
-        warnings.warn("Error occurred while trying to run 'psrcat' " \
-                        "to get prefname for '%s'" % name, \
-                        errors.CoastGuardWarning)
-        spinds = []
+    entries = search_psrcat_index(search)
+    if entries is not None:
+        spinds = [entry['spindex'] for entry in entries
+                  if entry['spindex'] is not None]
+        lines = [str(spind) for spind in spinds]
+    else:
+        try:   
+            cmd = ['psrcat', '-nohead', '-nonumber', '-c', 'SPINDX', \
+                            '-o', 'short', '-null', '', search]
+            stdout, stderr = execute(cmd)
+            lines = [line for line in stdout.split('\n') \
+                        if line.strip() and not line.startswith("WARNING:")]
+            spinds = [float(line.strip()) for line in lines]
+        except errors.SystemCallError:
+            warnings.warn("Error occurred while trying to run 'psrcat' " \
+                            "to get prefname for '%s'" % name, \
+                            errors.CoastGuardWarning)
+            spinds = []
     
     if len(spinds) == 1:
         spindex = spinds[0]
@@ -1052,18 +1467,23 @@ def get_jname(name):
         if not srcname[0] in ('J', 'B') and len(srcname)==7:
             # Could be B-name, or truncated J-name. Add wildcard at end just in case.
             search += '*'
-        try:   
-            cmd = ['psrcat', '-nohead', '-nonumber', '-c', 'PSRJ', \
-                            '-o', 'short', '-null', '', search]
-            stdout, stderr = execute(cmd)
-            lines = [line for line in stdout.split('\n') \
-                        if line.strip() and not line.startswith("WARNING:")]
-            names = [line.strip().split() for line in lines]
-        except errors.SystemCallError:
-            warnings.warn("Error occurred while trying to run 'psrcat' " \
-                            "to get J-name for '%s'" % srcname, \
-                            errors.CoastGuardWarning)
-            names = []
+        entries = search_psrcat_index(search)
+        if entries is not None:
+            names = [[entry['jname']] for entry in entries]
+            lines = [" ".join(nn) for nn in names]
+        else:
+            try:   
+                cmd = ['psrcat', '-nohead', '-nonumber', '-c', 'PSRJ', \
+                                '-o', 'short', '-null', '', search]
+                stdout, stderr = execute(cmd)
+                lines = [line for line in stdout.split('\n') \
+                            if line.strip() and not line.startswith("WARNING:")]
+                names = [line.strip().split() for line in lines]
+            except errors.SystemCallError:
+                warnings.warn("Error occurred while trying to run 'psrcat' " \
+                                "to get J-name for '%s'" % srcname, \
+                                errors.CoastGuardWarning)
+                names = []
     
         if len(names) == 1:
             jname = names[0][-1]
@@ -1113,18 +1533,24 @@ def get_prefname(name):
         if not srcname[0] in ('J', 'B') and len(srcname)==7:
             # Could be B-name, or truncated J-name. Add wildcard at end just in case.
             search += '*'
-        try:   
-            cmd = ['psrcat', '-nohead', '-nonumber', '-c', 'PSRJ PSRB', \
-                            '-o', 'short', '-null', '', search]
-            stdout, stderr = execute(cmd)
-            lines = [line for line in stdout.split('\n') \
-                        if line.strip() and not line.startswith("WARNING:")]
-            names = [line.strip().split() for line in lines]
-        except errors.SystemCallError:
-            warnings.warn("Error occurred while trying to run 'psrcat' " \
-                            "to get prefname for '%s'" % srcname, \
-                            errors.CoastGuardWarning)
-            names = []
+        entries = search_psrcat_index(search)
+        if entries is not None:
+            names = [[name for name in (entry['jname'], entry['bname'])
+                      if name] for entry in entries]
+            lines = [" ".join(nn) for nn in names]
+        else:
+            try:   
+                cmd = ['psrcat', '-nohead', '-nonumber', '-c', 'PSRJ PSRB', \
+                                '-o', 'short', '-null', '', search]
+                stdout, stderr = execute(cmd)
+                lines = [line for line in stdout.split('\n') \
+                            if line.strip() and not line.startswith("WARNING:")]
+                names = [line.strip().split() for line in lines]
+            except errors.SystemCallError:
+                warnings.warn("Error occurred while trying to run 'psrcat' " \
+                                "to get prefname for '%s'" % srcname, \
+                                errors.CoastGuardWarning)
+                names = []
     
         if len(names) == 1:
             prefname = names[0][-1]
@@ -1224,6 +1650,50 @@ def correct_asterix_header(arfn):
     return outarf
 
 
+def edit_archive(arf, edits=None, nchan=None, tscrunch=False,
+                 pscrunch=False, outfn=None):
+    """Apply header edits and scrunching to an archive in memory
+        using the psrchive python bindings, and write it out once.
+        This replaces chains of 'psredit' and 'pam' calls, each of
+        which would load and unload the whole file.
+
+        NOTE: The archive of 'arf' is modified in place.
+
+        Inputs:
+            arf: An ArchiveFile object. Its archive is loaded if
+                it isn't already in memory.
+            edits: A list of header edits, each in the same format
+                as used with 'psredit -c' (e.g. 'rcvr:name=P217-3').
+                (Default: no edits)
+            nchan: Scrunch to this number of channels.
+                (Default: don't scrunch in frequency)
+            tscrunch: Scrunch in time. (Default: False)
+            pscrunch: Scrunch polarisations. (Default: False)
+            outfn: The name of the output file.
+                (Default: overwrite the input file)
+
+        Output:
+            outarf: An ArchiveFile object for the output file. The
+                edited archive is kept in memory.
+    """
+    ar = arf.get_archive()
+    for edit in (edits or []):
+        print_debug("Editing archive header: %s" % edit, 'syscalls')
+        ar.execute("edit %s" % edit)
+    if (nchan is not None) and (int(nchan) != ar.get_nchan()):
+        ar.fscrunch_to_nchan(int(nchan))
+    if tscrunch:
+        ar.tscrunch()
+    if pscrunch:
+        ar.pscrunch()
+    if outfn is None:
+        outfn = arf.fn
+    ar.unload(outfn)
+    outarf = ArchiveFile(outfn)
+    outarf.ar = ar
+    return outarf
+
+
 def mjd_to_date(mjds):
     """Convert Modified Julian Day (MJD) to the year, month, day.
 
@@ -1324,6 +1794,42 @@ def add_group_permissions(fn, perms=""):
     os.chmod(fn, mode)
 
 
+class BackgroundMD5Sum(object):
+    """Compute the MD5 sum of a file in a background thread.
+        Start it as soon as the file has been written, while
+        its data are still in the page cache, and collect the
+        result with 'get' once other work on the file is done.
+    """
+    def __init__(self, fn, block_size=16*8192):
+        self.fn = fn
+        self.block_size = block_size
+        self.md5 = None
+        self.error = None
+        self.thread = threading.Thread(target=self._compute)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _compute(self):
+        try:
+            self.md5 = get_md5sum(self.fn, self.block_size)
+        except Exception as exc:
+            self.error = exc
+
+    def get(self):
+        """Wait for the MD5 sum to be computed and return it.
+
+            Inputs:
+                None
+
+            Output:
+                md5: The hexidecimal string of the MD5 checksum.
+        """
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.md5
+
+
 class ArchiveFile(object):
     def __init__(self, fn):
         self.fn = str(os.path.abspath(fn)) # Cast to string in case fn is unicode